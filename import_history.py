@@ -0,0 +1,329 @@
+# Uvoz stare povijesti razgovora u conversations.json
+# -------------------------------------------------
+# Spaja oba formata koja se nalaze u repozitoriju:
+#   memory.json        {uid: {full_name, messages: [{role, text, ts}], diary}}
+#   conversations.json {uid: [{timestamp, role, text}]}
+# u store koji čita Render bot (conversations.json).
+#
+# Izvori se čitaju inkrementalno (od izvora je u memoriji samo jedan korisnik),
+# vremena se svode na UTC ISO format kakav piše append_conversation, a isti
+# potezi iz više izvora se spajaju. Ponovno pokretanje ne dodaje duplikate,
+# a prekinuti uvoz se nastavlja od checkpointa.
+#
+# Ograničenje: odredišni store je jedan JSON objekt (tako ga čita i bot), pa
+# se učitava cijeli i nakon svakog batcha zapisuje cijeli. Memorija je dakle
+# ograničena veličinom storea + jednim korisnikom izvora; za velike storeove
+# povećaj --batch da bude manje prepisivanja. Postojeći potezi u storeu koje
+# uvoz ne razumije ostaju netaknuti.
+#
+# Pokretati dok bot NE radi (bot drži store u svojoj memoriji):
+#   python import_history.py memory.json conversations.json
+#   python import_history.py --batch 200 --store conversations.json memory.json
+
+import os
+import sys
+import json
+import time
+import argparse
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Iterator, Tuple
+
+CHUNK_SIZE = 64 * 1024
+DEFAULT_BATCH = 500
+# isti (role, text) unutar ovoliko sekundi smatra se istim potezom
+DEDUPE_WINDOW_S = 2.0
+
+ROLE_ALIASES = {"assistant": "bot"}
+
+_decoder = json.JSONDecoder()
+
+Turn = Tuple[datetime, str, str]
+
+
+# =====================================================
+# 1. INKREMENTALNO ČITANJE JSON-a
+# =====================================================
+
+
+class _ChunkReader:
+    def __init__(self, f, chunk_size: int) -> None:
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.dropped = 0      # znakovi već izbačeni iz buffera
+        self.eof = False
+
+    @property
+    def offset(self) -> int:
+        return self.dropped + self.pos
+
+    def fill(self, size: int | None = None) -> bool:
+        chunk = self.f.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.dropped += self.pos
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, ch: str) -> None:
+        got = self.peek()
+        if got != ch:
+            raise ValueError(f"očekivan '{ch}', a pronađen '{got}' na znaku {self.offset}")
+        self.pos += 1
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                obj, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # buffer raste geometrijski: velika vrijednost se ponovno parsira
+                # O(log n) puta umjesto jednom po chunku
+                if not self.fill(max(self.chunk_size, len(self.buf) - self.pos)):
+                    raise
+                continue
+            # broj na samom kraju buffera mogao je biti odrezan
+            if end == len(self.buf) and isinstance(obj, (int, float)) and not self.eof:
+                if self.fill():
+                    continue
+            self.pos = end
+            return obj
+
+
+def iter_top_level_items(path: str, chunk_size: int = CHUNK_SIZE) -> Iterator[Tuple[str, Any, int]]:
+    # vraća (ključ, vrijednost, pročitano znakova) za {"uid": ..., ...}
+    with open(path, "r", encoding="utf-8") as f:
+        r = _ChunkReader(f, chunk_size)
+        r.expect("{")
+        if r.peek() == "}":
+            return
+        while True:
+            key = r.value()
+            r.expect(":")
+            val = r.value()
+            yield str(key), val, r.offset
+            ch = r.peek()
+            if ch == ",":
+                r.pos += 1
+                continue
+            if ch == "}":
+                return
+            raise ValueError(f"neispravan JSON u {path} na znaku {r.offset}")
+
+
+# =====================================================
+# 2. NORMALIZACIJA I SPAJANJE
+# =====================================================
+
+
+def normalize_ts(raw: Any) -> datetime | None:
+    if not isinstance(raw, str) or not raw:
+        return None
+    try:
+        dt = datetime.fromisoformat(raw.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def parse_turn(m: Any) -> Turn | None:
+    if not isinstance(m, dict):
+        return None
+    ts = normalize_ts(m.get("timestamp") or m.get("ts"))
+    text = m.get("text")
+    role = m.get("role")
+    if ts is None or not isinstance(text, str) or not text or not isinstance(role, str):
+        return None
+    return ts, ROLE_ALIASES.get(role, role), text
+
+
+def turns_from_entry(value: Any) -> Tuple[List[Turn], int]:
+    # vraća (potezi, broj preskočenih neispravnih)
+    if isinstance(value, dict):
+        items = value.get("messages") or []       # memory.json
+    elif isinstance(value, list):
+        items = value                             # conversations.json
+    else:
+        return [], 0
+
+    turns: List[Turn] = []
+    skipped = 0
+    for m in items:
+        turn = parse_turn(m)
+        if turn is None:
+            skipped += 1
+            continue
+        turns.append(turn)
+    return turns, skipped
+
+
+def merge_turns(existing: List[Any], incoming: List[Turn], window_s: float) -> List[Any]:
+    # zapisi iz storea koje ne razumijemo ne brišemo – ostaju na početku, nepromijenjeni
+    current: List[Turn] = []
+    unparsed: List[Any] = []
+    for m in existing:
+        turn = parse_turn(m)
+        if turn is None:
+            unparsed.append(m)
+        else:
+            current.append(turn)
+    combined = sorted(current + incoming)
+
+    merged: List[Any] = list(unparsed)
+    last_seen: Dict[Tuple[str, str], datetime] = {}
+    for ts, role, text in combined:
+        key = (role, text)
+        prev = last_seen.get(key)
+        if prev is not None and (ts - prev).total_seconds() <= window_s:
+            continue
+        last_seen[key] = ts
+        merged.append({"timestamp": ts.isoformat(), "role": role, "text": text})
+    return merged
+
+
+# =====================================================
+# 3. STORE I CHECKPOINT
+# =====================================================
+
+
+def load_json(path: str, default: Any) -> Any:
+    if not os.path.exists(path):
+        return default
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_json_atomic(path: str, data: Any, indent: int | None = 2) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=indent, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def source_key(path: str) -> str:
+    # checkpoint vrijedi samo dok se izvorna datoteka ne promijeni
+    st = os.stat(path)
+    return f"{os.path.abspath(path)}:{st.st_size}:{int(st.st_mtime)}"
+
+
+# =====================================================
+# 4. UVOZ
+# =====================================================
+
+
+class ImportStats:
+    __slots__ = ("users", "turns_read", "turns_added", "skipped", "chars", "started")
+
+    def __init__(self) -> None:
+        self.users = 0
+        self.turns_read = 0
+        self.turns_added = 0
+        self.skipped = 0
+        self.chars = 0
+        self.started = time.perf_counter()
+
+    def line(self) -> str:
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        return (
+            f"korisnika {self.users}, poteza pročitano {self.turns_read}, dodano {self.turns_added}, "
+            f"preskočeno {self.skipped} | {self.turns_read / elapsed:,.0f} poteza/s, "
+            f"{self.chars / elapsed / 1e6:.2f} MB/s, {elapsed:.1f} s"
+        )
+
+
+def import_sources(
+    sources: List[str],
+    store_path: str,
+    checkpoint_path: str,
+    batch: int,
+    window_s: float,
+    restart: bool,
+) -> ImportStats:
+    store: Dict[str, List[Dict[str, Any]]] = load_json(store_path, {})
+    checkpoint: Dict[str, Any] = {} if restart else load_json(checkpoint_path, {})
+    stats = ImportStats()
+
+    for path in sources:
+        key = source_key(path)
+        state = checkpoint.get(key, {"users_done": 0, "done": False})
+        if state["done"]:
+            print(f"⏭️  {path} je već uvezen.")
+            continue
+
+        print(f"📥 Uvozim {path} (nastavak od korisnika {state['users_done']})…")
+        pending: Dict[str, List[Turn]] = {}
+        seen = 0
+        read_chars = 0
+
+        def commit() -> None:
+            changed = False
+            for uid, turns in pending.items():
+                before = store.get(uid, [])
+                merged = merge_turns(before, turns, window_s)
+                if merged != before:
+                    stats.turns_added += max(len(merged) - len(before), 0)
+                    store[uid] = merged
+                    changed = True
+            if changed:
+                save_json_atomic(store_path, store)
+            state["users_done"] = seen
+            checkpoint[key] = state
+            save_json_atomic(checkpoint_path, checkpoint, indent=None)
+            pending.clear()
+            print(f"   … {stats.line()}")
+
+        for uid, value, offset in iter_top_level_items(path):
+            stats.chars += offset - read_chars
+            read_chars = offset
+            seen += 1
+            if seen <= state["users_done"]:
+                continue
+
+            turns, skipped = turns_from_entry(value)
+            stats.users += 1
+            stats.turns_read += len(turns)
+            stats.skipped += skipped
+            if turns:
+                pending.setdefault(uid, []).extend(turns)
+
+            if seen - state["users_done"] >= batch:
+                commit()
+
+        state["done"] = True
+        commit()
+
+    return stats
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Uvoz memory.json / conversations.json povijesti u store bota.")
+    parser.add_argument("sources", nargs="+", help="izvorne JSON datoteke (oba formata)")
+    parser.add_argument("--store", default="conversations.json", help="store bota (default: conversations.json)")
+    parser.add_argument("--checkpoint", help="checkpoint datoteka (default: <store>.import-checkpoint.json)")
+    parser.add_argument("--batch", type=int, default=DEFAULT_BATCH, help="korisnika po jednom zapisu storea")
+    parser.add_argument("--window", type=float, default=DEDUPE_WINDOW_S, help="prozor za duplikate u sekundama")
+    parser.add_argument("--restart", action="store_true", help="zanemari checkpoint i kreni ispočetka")
+    args = parser.parse_args(argv)
+
+    checkpoint = args.checkpoint or args.store + ".import-checkpoint.json"
+    stats = import_sources(args.sources, args.store, checkpoint, max(args.batch, 1), args.window, args.restart)
+    print(f"✅ Gotovo: {stats.line()}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
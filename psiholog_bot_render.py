@@ -1,18 +1,42 @@
-# Psiholog Bot – Render webhook verzija
+# Psiholog Bot – zajednički handleri + webhook (Render) ili long polling transport
 # Integrirani meni, terapijski mod, dnevnik emocija, /menu, /help i povratak na glavni meni
+# Pokretanje: python psiholog_bot.py [webhook|polling]
 
 import os
+import sys
 import json
+import time
+import re
+import math
+import uuid
+import bisect
+import heapq
+import random
+import signal
 import asyncio
-from datetime import datetime, timedelta, time as dtime
-from typing import Dict, Any, List
+import logging
+import functools
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+from contextvars import ContextVar
+from array import array
+from enum import Enum
+from datetime import datetime, date, timedelta, timezone, time as dtime
+from typing import Dict, Any, List, Deque, Iterator, Tuple, Callable, Awaitable
 import threading
 
-from flask import Flask, request
+from flask import Flask, request, jsonify
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import (
+    AsyncOpenAI,
+    APIConnectionError,
+    RateLimitError,
+    InternalServerError,
+)
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -42,10 +66,398 @@ try:
 except Exception:
     raise RuntimeError("ADMIN_ID mora biti broj!")
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+# ponovne pokušaje radimo sami (vidi ai_chat_reply), pa ih klijent ne smije dodatno ponavljati
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+
+# =====================================================
+# 2. TRACING I STRUKTURIRANI LOGOVI
+# =====================================================
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+# httpx na INFO razini logira puni URL, a u njemu je token bota
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logger = logging.getLogger("psiholog")
+
+
+class JsonLineFormatter(logging.Formatter):
+    # jedan JSON objekt po liniji: ts, level + polja iz log_event
+    def format(self, record: logging.LogRecord) -> str:
+        line = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            **getattr(record, "fields", {"msg": record.getMessage()}),
+        }
+        return json.dumps(line, ensure_ascii=False, default=str)
+
+
+trace_logger = logging.getLogger("psiholog.trace")
+_trace_handler = logging.StreamHandler()
+_trace_handler.setFormatter(JsonLineFormatter())
+trace_logger.addHandler(_trace_handler)
+trace_logger.propagate = False
+
+# update sporiji od praga sprema se u cijelosti (svi spanovi) u ring buffer
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", "3000"))
+SLOW_TRACES: Deque[Dict[str, Any]] = deque(maxlen=int(os.getenv("SLOW_TRACE_BUFFER", "50")))
+
+
+class Trace:
+    __slots__ = ("trace_id", "update_id", "started", "spans")
+
+    def __init__(self, update_id: int | None = None) -> None:
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.update_id = update_id
+        self.started = time.perf_counter()
+        self.spans: List[Dict[str, Any]] = []
+
+
+_current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+
+
+def log_event(event: str, **fields: Any) -> None:
+    fields["event"] = event
+    trace_logger.info(event, extra={"fields": fields})
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Dict[str, Any]]:
+    trace = _current_trace.get()
+    start = time.perf_counter()
+    record: Dict[str, Any] = {"span": name, **attrs}
+    try:
+        yield record
+    except BaseException as e:
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        record["ms"] = round((time.perf_counter() - start) * 1000, 2)
+        if trace is not None:
+            record["trace_id"] = trace.trace_id
+            record["offset_ms"] = round((start - trace.started) * 1000, 2)
+            trace.spans.append(record)
+        log_event("span", **record)
+
+
+def finish_trace(trace: Trace, **attrs: Any) -> None:
+    total_ms = round((time.perf_counter() - trace.started) * 1000, 2)
+    log_event(
+        "update",
+        trace_id=trace.trace_id,
+        update_id=trace.update_id,
+        ms=total_ms,
+        spans=len(trace.spans),
+        **attrs,
+    )
+    if total_ms >= SLOW_UPDATE_MS:
+        SLOW_TRACES.append(
+            {
+                "trace_id": trace.trace_id,
+                "update_id": trace.update_id,
+                "at": datetime.utcnow().isoformat(),
+                "ms": total_ms,
+                **attrs,
+                "spans": list(trace.spans),
+            }
+        )
+
+
+def traced_handler(callback):
+    @functools.wraps(callback)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        with span(f"handler.{callback.__name__}"):
+            return await callback(update, context)
+
+    return wrapper
+
+
+# HTTPXRequest() sam po sebi ima samo 1 konekciju; builder inače koristi 256
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "256"))
+
+
+class TracedRequest(HTTPXRequest):
+    # svaki odlazni poziv Telegram API-ja dobiva svoj span
+    def __init__(self, *args, connection_pool_size: int = TELEGRAM_POOL_SIZE, **kwargs) -> None:
+        super().__init__(*args, connection_pool_size=connection_pool_size, **kwargs)
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        with span("telegram." + url.rsplit("/", 1)[-1], http_method=method) as rec:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            rec["status"] = code
+            if 200 <= code < 300:
+                HEALTH.last_telegram_ok = time.monotonic()
+            return code, payload
+
+
+def describe_update(update: Update) -> str:
+    # bez teksta poruke u logovima – samo vrsta updatea
+    if update.callback_query:
+        return f"callback:{update.callback_query.data}"
+    if update.message and update.message.text and update.message.text.startswith("/"):
+        return "command:" + update.message.text.split()[0]
+    if update.message:
+        return "message"
+    return "other"
+
 
 # =====================================================
-# 2. JSON FILES
+# 3. ZDRAVLJE I METRIKE
+# =====================================================
+
+HEALTH_PROBE_INTERVAL = float(os.getenv("HEALTH_PROBE_INTERVAL", "0.5"))
+READY_MAX_LOOP_LAG_MS = float(os.getenv("READY_MAX_LOOP_LAG_MS", "1000"))
+READY_MAX_INFLIGHT_UPDATES = int(os.getenv("READY_MAX_INFLIGHT_UPDATES", "200"))
+READY_MAX_STORAGE_BACKLOG = int(os.getenv("READY_MAX_STORAGE_BACKLOG", "1000"))
+# ako loop ne odgovori ovoliko dugo, /healthz pada i platforma restarta proces
+LIVE_MAX_LOOP_STALL_S = float(os.getenv("LIVE_MAX_LOOP_STALL_S", "30"))
+
+
+class HealthStats:
+    __slots__ = (
+        "loop_lag_ms",
+        "lag_window",
+        "last_probe",
+        "inflight_updates",
+        "inflight_llm",
+        "storage_backlog",
+        "last_openai_ok",
+        "last_telegram_ok",
+    )
+
+    def __init__(self) -> None:
+        self.loop_lag_ms = 0.0
+        self.lag_window: Deque[float] = deque(maxlen=120)
+        self.last_probe = 0.0               # time.monotonic() zadnjeg mjerenja
+        self.inflight_updates = 0
+        self.inflight_llm = 0
+        self.storage_backlog = 0            # započeta, a nedovršena zapisivanja (uz to i neflushani podaci)
+        self.last_openai_ok: float | None = None
+        self.last_telegram_ok: float | None = None
+
+
+HEALTH = HealthStats()
+
+
+async def loop_lag_probe() -> None:
+    # koliko kasni buđenje iz sleepa = koliko dugo je nešto blokiralo event loop
+    ev_loop = asyncio.get_running_loop()
+    while True:
+        start = ev_loop.time()
+        await asyncio.sleep(HEALTH_PROBE_INTERVAL)
+        lag_ms = max((ev_loop.time() - start - HEALTH_PROBE_INTERVAL) * 1000, 0.0)
+        HEALTH.loop_lag_ms = lag_ms
+        HEALTH.lag_window.append(lag_ms)
+        HEALTH.last_probe = time.monotonic()
+
+
+def health_snapshot() -> Dict[str, Any]:
+    now = time.monotonic()
+
+    # ako je loop potpuno zapeo, probe ne stiže ažurirati lag – gledamo i starost zadnjeg mjerenja
+    stalled_ms = (now - HEALTH.last_probe - HEALTH_PROBE_INTERVAL) * 1000 if HEALTH.last_probe else 0.0
+
+    def since(ts: float | None) -> float | None:
+        return None if ts is None else round(now - ts, 1)
+
+    return {
+        "loop_lag_ms": round(max(HEALTH.loop_lag_ms, stalled_ms), 1),
+        "loop_lag_max_ms": round(max(HEALTH.lag_window, default=0.0), 1),
+        "inflight_updates": HEALTH.inflight_updates,
+        "inflight_llm": HEALTH.inflight_llm,
+        "storage_backlog": HEALTH.storage_backlog + len(_dirty_users) + _pending_turns,
+        "since_openai_ok_s": since(HEALTH.last_openai_ok),
+        "since_telegram_ok_s": since(HEALTH.last_telegram_ok),
+        "single_flight": SINGLE_FLIGHT.stats(),
+        "llm_breaker": LLM_BREAKER.snapshot(),
+        "llm": LLM_STATS.snapshot(),
+        "lanes": {name: lane.snapshot() for name, lane in LANES.items()},
+    }
+
+
+def readiness_problems(snap: Dict[str, Any]) -> List[str]:
+    problems: List[str] = []
+    if not HEALTH.last_probe:
+        problems.append("loop probe još nije izmjerio lag")
+    if snap["loop_lag_ms"] > READY_MAX_LOOP_LAG_MS:
+        problems.append(f"loop lag {snap['loop_lag_ms']} ms > {READY_MAX_LOOP_LAG_MS:.0f} ms")
+    if snap["inflight_updates"] > READY_MAX_INFLIGHT_UPDATES:
+        problems.append(f"{snap['inflight_updates']} updateova u obradi > {READY_MAX_INFLIGHT_UPDATES}")
+    if snap["storage_backlog"] > READY_MAX_STORAGE_BACKLOG:
+        problems.append(f"storage backlog {snap['storage_backlog']} > {READY_MAX_STORAGE_BACKLOG}")
+    return problems
+
+
+# =====================================================
+# 4. PROFILER (UZORKOVANJE STOGOVA)
+# =====================================================
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "30"))
+# PROFILE_ON_START=<sekunde> – uzorkuj sve dretve odmah nakon pokretanja
+PROFILE_ON_START = float(os.getenv("PROFILE_ON_START", "0"))
+# PROFILE_EVERY_N=<n> – uzorkuj svaki n-ti process_update (0 = isključeno)
+PROFILE_EVERY_N = int(os.getenv("PROFILE_EVERY_N", "0"))
+# koliko uzorkovanih updateova ide u jednu datoteku
+PROFILE_UPDATE_BATCH = int(os.getenv("PROFILE_UPDATE_BATCH", "50"))
+
+
+class SamplingProfiler:
+    # pozadinska dretva čita sys._current_frames() – dok profiler ne postoji, nema nikakvog troška
+    def __init__(
+        self,
+        label: str,
+        thread_ids: set[int] | None = None,
+        gate: Callable[[], bool] | None = None,
+    ) -> None:
+        self.label = label
+        self.thread_ids = thread_ids      # None = sve dretve
+        self.gate = gate                  # uzorkuje se samo kad gate() vrati True
+        self.samples: Dict[Tuple[str, ...], int] = {}
+        self.sample_count = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"profiler-{label}", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> str:
+        self._stop.set()
+        self._thread.join()
+        return self._write()
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        interval = PROFILE_INTERVAL_MS / 1000
+        while not self._stop.wait(interval):
+            if self.gate is not None and not self.gate():
+                continue
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for tid, frame in sys._current_frames().items():
+                if tid == own or (self.thread_ids is not None and tid not in self.thread_ids):
+                    continue
+                stack: List[str] = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(tid, str(tid)))
+                key = tuple(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+            self.sample_count += 1
+
+    def _write(self) -> str:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+        base = os.path.join(PROFILE_DIR, f"profile-{stamp}-{self.label}")
+
+        # collapsed stacks – ulaz za flamegraph.pl / speedscope
+        with open(base + ".collapsed", "w", encoding="utf-8") as f:
+            for stack, n in sorted(self.samples.items(), key=lambda kv: -kv[1]):
+                f.write(";".join(stack) + f" {n}\n")
+
+        self_counts: Dict[str, int] = {}
+        total_counts: Dict[str, int] = {}
+        for stack, n in self.samples.items():
+            self_counts[stack[-1]] = self_counts.get(stack[-1], 0) + n
+            for fn in set(stack[1:]):
+                total_counts[fn] = total_counts.get(fn, 0) + n
+        total = sum(self.samples.values()) or 1
+
+        with open(base + ".top.txt", "w", encoding="utf-8") as f:
+            f.write(f"# {self.label}: {self.sample_count} uzoraka, {total} stogova\n")
+            f.write("#  self%  total%  funkcija\n")
+            top = sorted(self_counts.items(), key=lambda kv: -kv[1])[:PROFILE_TOP_N]
+            for fn, n in top:
+                f.write(f"{n / total * 100:7.2f} {total_counts[fn] / total * 100:7.2f}  {fn}\n")
+
+        log_event("profile", label=self.label, samples=self.sample_count, path=base)
+        return base
+
+
+_active_profiler: SamplingProfiler | None = None
+_profiler_lock = threading.Lock()
+
+
+def start_profiling(
+    label: str,
+    seconds: float,
+    on_done: Callable[[str], None] | None = None,
+) -> bool:
+    global _active_profiler
+    with _profiler_lock:
+        if _active_profiler is not None:
+            return False
+        prof = SamplingProfiler(label)
+        _active_profiler = prof
+    prof.start()
+
+    timer = threading.Timer(seconds, stop_profiling, args=(prof, on_done))
+    timer.daemon = True
+    timer.start()
+    return True
+
+
+def stop_profiling(
+    prof: SamplingProfiler | None = None,
+    on_done: Callable[[str], None] | None = None,
+) -> str | None:
+    global _active_profiler
+    with _profiler_lock:
+        if _active_profiler is None or (prof is not None and prof is not _active_profiler):
+            return None
+        prof = _active_profiler
+        _active_profiler = None
+    path = prof.stop()
+    if on_done:
+        on_done(path)
+    return path
+
+
+# uzorkovanje svakog n-tog updatea – sve se odvija na event loop dretvi, bez lockova
+_update_profiler: SamplingProfiler | None = None
+_profiled_inflight = 0
+_profiled_updates = 0
+_update_counter = 0
+
+
+def profile_update_begin() -> bool:
+    global _update_profiler, _profiled_inflight, _update_counter
+    _update_counter += 1
+    if _update_counter % PROFILE_EVERY_N:
+        return False
+    if _update_profiler is None:
+        _update_profiler = SamplingProfiler(
+            "updates",
+            thread_ids={threading.get_ident()},
+            gate=lambda: _profiled_inflight > 0,
+        )
+        _update_profiler.start()
+    _profiled_inflight += 1
+    return True
+
+
+def profile_update_end() -> None:
+    global _profiled_inflight, _profiled_updates
+    _profiled_inflight -= 1
+    _profiled_updates += 1
+    if _profiled_updates >= PROFILE_UPDATE_BATCH:
+        stop_update_profiling()
+
+
+def stop_update_profiling() -> bool:
+    # zaustavlja dretvu i zapisuje uzorke (pun batch ili djelomičan nakon /profiler every 0)
+    global _update_profiler, _profiled_updates
+    if _update_profiler is None:
+        return False
+    # zapisivanje na disk ne smije blokirati event loop
+    threading.Thread(target=_update_profiler.stop, daemon=True).start()
+    _update_profiler = None
+    _profiled_updates = 0
+    return True
+
+
+# =====================================================
+# 5. JSON FILES
 # =====================================================
 
 USERS_FILE = "users.json"
@@ -61,125 +473,496 @@ def ensure_files_exist():
             json.dump({}, f)
 
 
+# korisnici se drže u memoriji, a promijenjeni se periodički zapisuju na disk
+STORAGE_FLUSH_INTERVAL = float(os.getenv("STORAGE_FLUSH_INTERVAL", "2"))
+
+
+# zapisi idu iz dretvi (periodički flush, gašenje) – jedan po jedan, inače dijele isti .tmp
+_storage_write_lock = threading.Lock()
+
+
+def write_bytes_atomic(path: str, data: bytes) -> None:
+    # prvo u privremenu datoteku pa os.replace – nikad napola zapisan JSON
+    with _storage_write_lock:
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+
+def write_json_atomic(path: str, data: Any) -> None:
+    write_bytes_atomic(path, json.dumps(data, ensure_ascii=False).encode())
+
+
 def load_users() -> Dict[str, Any]:
-    with open(USERS_FILE, "r", encoding="utf-8") as f:
+    with span("storage.load_users"), open(USERS_FILE, "r", encoding="utf-8") as f:
         return json.load(f)
 
 
-def save_users(data: Dict[str, Any]) -> None:
-    with open(USERS_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+def save_users(parts: Dict[str, bytes]) -> None:
+    # parts: uid → već serijalizirani korisnik; ovdje se samo spajaju (jedan korisnik po retku)
+    HEALTH.storage_backlog += 1
+    try:
+        with span("storage.save_users", users=len(parts)):
+            body = b",\n".join(json.dumps(uid).encode() + b": " + js for uid, js in parts.items())
+            write_bytes_atomic(USERS_FILE, b"{\n" + body + b"\n}\n")
+    finally:
+        HEALTH.storage_backlog -= 1
 
 
 def load_conversations() -> Dict[str, Any]:
-    with open(CONVERSATIONS_FILE, "r", encoding="utf-8") as f:
+    with span("storage.load_conversations"), open(CONVERSATIONS_FILE, "r", encoding="utf-8") as f:
         return json.load(f)
 
 
-def save_conversations(data: Dict[str, Any]) -> None:
-    with open(CONVERSATIONS_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+def save_conversations(parts: Dict[str, bytes]) -> None:
+    # isto kao save_users: uid → već serijalizirana lista poteza, jedan korisnik po retku
+    HEALTH.storage_backlog += 1
+    try:
+        with span("storage.save_conversations", users=len(parts)):
+            body = b",\n".join(json.dumps(uid).encode() + b": " + js for uid, js in parts.items())
+            write_bytes_atomic(CONVERSATIONS_FILE, b"{\n" + body + b"\n}\n")
+    finally:
+        HEALTH.storage_backlog -= 1
 
 
 ensure_files_exist()
 
 # =====================================================
-# 3. KORISNICI
+# 6. KORISNICI
 # =====================================================
 
 
-USER_DEFAULTS: Dict[str, Any] = {
-    "approved": True,              # default: odmah odobren (osim ako želiš ručno mijenjati)
-    "waiting": False,
-    "subscription_until": (datetime.utcnow() + timedelta(days=7)).strftime("%Y-%m-%d"),
-    "premium": False,
-    # terapija & stil
-    "therapist": "standard",
-    "therapy_mode": "NONE",      # NONE, CBT, ACT, DBT
-    # dnevnik emocija
-    "mood_log": [],               # lista dictova {timestamp, rating, note}
-    "mood_pending_rating": None,  # privremeno, kad čekaš opis nakon odabira 1–5
-    "daily_check": False,         # automatska dnevna provjera
+class TherapyMode(Enum):
+    NONE = "NONE"
+    CBT = "CBT"
+    ACT = "ACT"
+    DBT = "DBT"
+
+    @classmethod
+    def parse(cls, raw: Any) -> "TherapyMode":
+        try:
+            return cls(raw)
+        except ValueError:
+            return cls.NONE
+
+
+MOOD_LOG_LIMIT = 90
+# APPROVAL_REQUIRED=1 – novi korisnici čekaju /approve administratora
+APPROVAL_REQUIRED = os.getenv("APPROVAL_REQUIRED", "0") == "1"
+NOT_APPROVED_TEXT = "⏳ Tvoj pristup još nije odobren. Pričekaj administratora."
+TRIAL_DAYS = 7
+ADMIN_SUBSCRIPTION_UNTIL = date(2099, 12, 31).toordinal()
+# neispravan datum pretplate = istekla pretplata
+INVALID_DATE_ORDINAL = 1
+MOOD_TS_FORMAT = "%Y-%m-%d %H:%M"
+EPOCH = datetime(1970, 1, 1)
+
+_USER_KEYS = {
+    "name",
+    "approved",
+    "waiting",
+    "subscription_until",
+    "premium",
+    "therapist",
+    "therapy_mode",
+    "mood_log",
+    "mood_pending_rating",
+    "daily_check",
+    "crisis_flagged",
+    "test_log",
 }
 
 
-def get_or_create_user(user_id: int, name: str) -> Dict[str, Any]:
-    users = load_users()
+def today_ordinal() -> int:
+    return datetime.utcnow().date().toordinal()
+
+
+def parse_date_ordinal(raw: Any) -> int:
+    try:
+        return datetime.strptime(raw, "%Y-%m-%d").date().toordinal()
+    except (TypeError, ValueError):
+        return INVALID_DATE_ORDINAL
+
+
+def parse_mood_minutes(raw: Any) -> int:
+    try:
+        return int((datetime.strptime(raw, MOOD_TS_FORMAT) - EPOCH).total_seconds() // 60)
+    except (TypeError, ValueError):
+        return 0
+
+
+class UserRecord:
+    __slots__ = (
+        "name",
+        "approved",
+        "waiting",
+        "subscription_until",   # ordinal datuma (date.toordinal)
+        "premium",
+        "therapist",
+        "therapy_mode",
+        "mood_minutes",         # dnevnik emocija kao paralelni nizovi: minute od epohe (UTC)…
+        "mood_ratings",         # …ocjena 1–5…
+        "mood_notes",           # …i internirane bilješke
+        "mood_pending_rating",  # privremeno, kad čekaš opis nakon odabira 1–5
+        "daily_check",          # automatska dnevna provjera
+        "crisis_flagged",       # ISO vrijeme zadnjeg kriznog signala, čeka pregled admina
+        "test_log",             # {test: (minute od epohe, bodovi)} – uz dnevnik, None dok nema rezultata
+        "extra",                # nepoznati ključevi iz JSON-a, da se ne izgube pri spremanju
+    )
+
+    def __init__(self, name: str = "") -> None:
+        self.name = name
+        self.approved = True    # default: odmah odobren (osim ako želiš ručno mijenjati)
+        self.waiting = False
+        self.subscription_until = today_ordinal() + TRIAL_DAYS
+        self.premium = False
+        self.therapist = "standard"
+        self.therapy_mode = TherapyMode.NONE
+        self.mood_minutes = array("i")
+        self.mood_ratings = array("b")
+        self.mood_notes: List[str] = []
+        self.mood_pending_rating: int | None = None
+        self.daily_check = False
+        self.crisis_flagged: str | None = None
+        self.test_log: Dict[str, Tuple[array, array]] | None = None
+        self.extra: Dict[str, Any] | None = None
+
+    @property
+    def subscription_until_str(self) -> str:
+        return date.fromordinal(self.subscription_until).strftime("%Y-%m-%d")
+
+    def mood_entries(self, last: int = MOOD_LOG_LIMIT) -> Iterator[Tuple[str, int, str]]:
+        n = len(self.mood_ratings)
+        for i in range(max(n - last, 0), n):
+            ts = (EPOCH + timedelta(minutes=self.mood_minutes[i])).strftime(MOOD_TS_FORMAT)
+            yield ts, self.mood_ratings[i], self.mood_notes[i]
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "UserRecord":
+        u = cls(d.get("name") or "")
+        u.approved = bool(d.get("approved", True))
+        u.waiting = bool(d.get("waiting", False))
+        if "subscription_until" in d:
+            u.subscription_until = parse_date_ordinal(d["subscription_until"])
+        u.premium = bool(d.get("premium", False))
+        u.therapist = d.get("therapist", "standard")
+        u.therapy_mode = TherapyMode.parse(d.get("therapy_mode", "NONE"))
+        for e in (d.get("mood_log") or [])[-MOOD_LOG_LIMIT:]:
+            u.mood_minutes.append(parse_mood_minutes(e.get("timestamp")))
+            u.mood_ratings.append(int(e.get("rating", 0)))
+            u.mood_notes.append(sys.intern(e.get("note") or ""))
+        u.mood_pending_rating = d.get("mood_pending_rating")
+        u.daily_check = bool(d.get("daily_check", False))
+        u.crisis_flagged = d.get("crisis_flagged")
+        for code, entries in (d.get("test_log") or {}).items():
+            minutes, scores = array("i"), array("b")
+            for e in entries:
+                minutes.append(parse_mood_minutes(e.get("timestamp")))
+                scores.append(int(e.get("score", 0)))
+            if u.test_log is None:
+                u.test_log = {}
+            u.test_log[code] = (minutes, scores)
+        extra = {k: v for k, v in d.items() if k not in _USER_KEYS}
+        u.extra = extra or None
+        return u
+
+    def to_dict(self) -> Dict[str, Any]:
+        d: Dict[str, Any] = {
+            "approved": self.approved,
+            "waiting": self.waiting,
+            "subscription_until": self.subscription_until_str,
+            "premium": self.premium,
+            "therapist": self.therapist,
+            "therapy_mode": self.therapy_mode.value,
+            "mood_log": [
+                {"timestamp": ts, "rating": rating, "note": note}
+                for ts, rating, note in self.mood_entries()
+            ],
+            "mood_pending_rating": self.mood_pending_rating,
+            "daily_check": self.daily_check,
+            "crisis_flagged": self.crisis_flagged,
+            "name": self.name,
+        }
+        if self.test_log:
+            d["test_log"] = {
+                code: [
+                    {
+                        "timestamp": (EPOCH + timedelta(minutes=m)).strftime(MOOD_TS_FORMAT),
+                        "score": score,
+                    }
+                    for m, score in zip(minutes, scores)
+                ]
+                for code, (minutes, scores) in self.test_log.items()
+            }
+        if self.extra:
+            d.update(self.extra)
+        return d
+
+
+USERS: Dict[str, UserRecord] | None = None
+_dirty_users: set[str] = set()
+# uid → JSON korisnika kakav je zadnji put zapisan; flush ponovno serijalizira samo dirty korisnike
+# (UTF-8 bytes – upola manje od str s dijakriticima, koji Python drži po 2 bajta po znaku)
+_user_json: Dict[str, bytes] = {}
+
+
+def apply_admin_privileges(user: UserRecord) -> None:
+    # admin uvijek premium i "beskonačna" pretplata
+    user.approved = True
+    user.premium = True
+    user.subscription_until = ADMIN_SUBSCRIPTION_UNTIL
+    user.waiting = False
+
+
+def users_cache() -> Dict[str, UserRecord]:
+    # users.json se parsira samo jednom, pri prvom pristupu
+    global USERS
+    if USERS is None:
+        raw = load_users()
+        USERS = {uid: UserRecord.from_dict(d) for uid, d in raw.items()}
+        _user_json.update((uid, json.dumps(d, ensure_ascii=False).encode()) for uid, d in raw.items())
+        if ADMIN_ID and str(ADMIN_ID) in USERS:
+            apply_admin_privileges(USERS[str(ADMIN_ID)])
+            _dirty_users.add(str(ADMIN_ID))
+    return USERS
+
+
+async def flush_users_async() -> None:
+    # na event loopu se serijaliziraju samo promijenjeni korisnici, spajanje i zapis idu u dretvu
+    if not _dirty_users:
+        return
+    users = users_cache()
+    dirty = set(_dirty_users)
+    for uid in dirty:
+        _user_json[uid] = json.dumps(users[uid].to_dict(), ensure_ascii=False).encode()
+    _dirty_users.difference_update(dirty)
+    try:
+        await asyncio.to_thread(save_users, dict(_user_json))
+    except BaseException:
+        # zapis nije uspio (ili je prekinut) – ostaju dirty za sljedeći pokušaj
+        _dirty_users.update(dirty)
+        raise
+
+
+async def storage_flush_loop() -> None:
+    while True:
+        await asyncio.sleep(STORAGE_FLUSH_INTERVAL)
+        try:
+            await flush_users_async()
+            await flush_conversations_async()
+        except Exception:
+            logger.exception("Spremanje podataka nije uspjelo")
+
+
+def get_or_create_user(user_id: int, name: str) -> UserRecord:
+    users = users_cache()
     uid = str(user_id)
 
-    if uid not in users:
+    user = users.get(uid)
+    if user is None:
         # novi korisnik
-        data = USER_DEFAULTS.copy()
-        data["name"] = name
-        # admin uvijek premium i "beskonačna" pretplata
+        user = UserRecord(name)
         if ADMIN_ID and user_id == ADMIN_ID:
-            data["approved"] = True
-            data["premium"] = True
-            data["subscription_until"] = "2099-12-31"
-            data["waiting"] = False
-        users[uid] = data
-        save_users(users)
-        return data
-
-    # već postoji – dopuni eventualno nove ključeve
-    user = users[uid]
-    for k, v in USER_DEFAULTS.items():
-        user.setdefault(k, v)
-
-    user.setdefault("name", name)
-
-    # admin zaštita
-    if ADMIN_ID and user_id == ADMIN_ID:
-        user["approved"] = True
-        user["premium"] = True
-        user["subscription_until"] = "2099-12-31"
-        user["waiting"] = False
-
-    users[uid] = user
-    save_users(users)
+            apply_admin_privileges(user)
+        elif APPROVAL_REQUIRED:
+            user.approved = False
+            user.waiting = True
+        users[uid] = user
+        _dirty_users.add(uid)
+    elif not user.name:
+        user.name = name
+        _dirty_users.add(uid)
     return user
 
 
-def save_user(user_id: int, new_data: Dict[str, Any]) -> None:
-    users = load_users()
+def save_user(user_id: int, user: UserRecord) -> None:
     uid = str(user_id)
-    if uid in users:
-        users[uid].update(new_data)
-        save_users(users)
+    if uid in users_cache():
+        _dirty_users.add(uid)
 
 
-def get_user_str(uid: str) -> Dict[str, Any] | None:
-    return load_users().get(uid)
+def get_user_str(uid: str) -> UserRecord | None:
+    return users_cache().get(uid)
 
 
-def is_subscription_active(u: Dict[str, Any]) -> bool:
-    try:
-        until = datetime.strptime(u.get("subscription_until", "1970-01-01"), "%Y-%m-%d").date()
-        return until >= datetime.utcnow().date()
-    except Exception:
-        return False
+def is_subscription_active(u: UserRecord) -> bool:
+    return u.subscription_until >= today_ordinal()
 
 
 # =====================================================
-# 4. KONVERZACIJE
+# 7. KONVERZACIJE I PRETRAGA POVIJESTI
 # =====================================================
 
+HISTORY_PAGE_SIZE = 5
+HISTORY_MAX_HITS = 100
+HISTORY_SNIPPET_CHARS = 70
+# BM25 parametri
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# conversations.json se, kao i korisnici, čita jednom i periodički zapisuje
+CONVERSATIONS: Dict[str, List[Dict[str, Any]]] | None = None
+_pending_turns = 0
+_dirty_conversations: set[str] = set()
+# uid → (JSON lista poteza u UTF-8, koliko je poteza u njoj); potezi se samo dodaju,
+# pa flush serijalizira samo nove poteze i dopisuje ih na kraj postojećeg JSON-a
+_conversation_json: Dict[str, Tuple[bytes, int]] = {}
+
+
+def conversations_cache() -> Dict[str, List[Dict[str, Any]]]:
+    global CONVERSATIONS
+    if CONVERSATIONS is None:
+        CONVERSATIONS = load_conversations()
+        _conversation_json.update(
+            (uid, (json.dumps(turns, ensure_ascii=False).encode(), len(turns)))
+            for uid, turns in CONVERSATIONS.items()
+        )
+    return CONVERSATIONS
+
+
+async def flush_conversations_async() -> None:
+    global _pending_turns
+    if not _dirty_conversations:
+        return
+    conversations = conversations_cache()
+    dirty = set(_dirty_conversations)
+    for uid in dirty:
+        turns = conversations[uid]
+        cached, done = _conversation_json.get(uid, (b"[]", 0))
+        if done == len(turns):
+            continue
+        new = json.dumps(turns[done:], ensure_ascii=False).encode()
+        joined = cached[:-1] + b", " + new[1:] if done else new
+        _conversation_json[uid] = (joined, len(turns))
+    _dirty_conversations.difference_update(dirty)
+    pending, _pending_turns = _pending_turns, 0
+    try:
+        await asyncio.to_thread(
+            save_conversations, {uid: js for uid, (js, _) in _conversation_json.items()}
+        )
+    except BaseException:
+        _dirty_conversations.update(dirty)
+        _pending_turns += pending
+        raise
+
+
+_FOLD_TABLE = str.maketrans("čćšžđČĆŠŽĐ", "ccszdCCSZD")
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def fold_text(text: str) -> str:
+    # "Čuđenje" → "cudenje"; duljina ostaje ista, pa pozicije vrijede i za original
+    return text.translate(_FOLD_TABLE).lower()
+
+
+def tokenize(text: str) -> List[str]:
+    # "dj" je uobičajen ASCII zapis za "đ"
+    return [t.replace("dj", "d") for t in _TOKEN_RE.findall(fold_text(text))]
+
+
+class HistoryIndex:
+    # invertirani indeks nad potezima jednog korisnika: pojam → {redni broj poteza: tf}
+    __slots__ = ("postings", "lengths", "total_length", "_vocab")
+
+    def __init__(self) -> None:
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.lengths = array("I")
+        self.total_length = 0
+        self._vocab: List[str] | None = None
+
+    def add(self, text: str) -> None:
+        doc = len(self.lengths)
+        tokens = tokenize(text)
+        for t in tokens:
+            posting = self.postings.get(t)
+            if posting is None:
+                posting = self.postings[t] = {}
+                self._vocab = None
+            posting[doc] = posting.get(doc, 0) + 1
+        self.lengths.append(len(tokens))
+        self.total_length += len(tokens)
+
+    def expand(self, term: str) -> List[str]:
+        # prefiks pokriva padeže i oblike: "umor" → umoran, umorna, umoru…
+        if len(term) < 3:
+            return [term] if term in self.postings else []
+        if self._vocab is None:
+            self._vocab = sorted(self.postings)
+        i = bisect.bisect_left(self._vocab, term)
+        out: List[str] = []
+        while i < len(self._vocab) and self._vocab[i].startswith(term):
+            out.append(self._vocab[i])
+            i += 1
+        return out
+
+    def search(self, query: str) -> List[int]:
+        n = len(self.lengths)
+        if not n:
+            return []
+        avg_len = self.total_length / n or 1.0
+        scores: Dict[int, float] = {}
+        for q in set(tokenize(query)):
+            for term in self.expand(q):
+                posting = self.postings[term]
+                idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+                for doc, tf in posting.items():
+                    norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[doc] / avg_len)
+                    scores[doc] = scores.get(doc, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+        # jednaki rezultat → noviji potez prvi
+        ranked = heapq.nlargest(HISTORY_MAX_HITS, scores.items(), key=lambda kv: (kv[1], kv[0]))
+        return [doc for doc, _ in ranked]
+
+
+HISTORY_INDEXES: Dict[str, HistoryIndex] = {}
+
+
+def history_index(uid: str) -> HistoryIndex:
+    # gradi se pri prvoj pretrazi, a dalje ga održava append_conversation
+    index = HISTORY_INDEXES.get(uid)
+    if index is None:
+        index = HistoryIndex()
+        with span("history.build_index") as rec:
+            for turn in conversations_cache().get(uid, []):
+                index.add(turn.get("text", ""))
+            rec["turns"] = len(index.lengths)
+        HISTORY_INDEXES[uid] = index
+    return index
+
+
+def history_snippet(text: str, query: str) -> str:
+    folded = fold_text(text)
+    pos = -1
+    for q in _TOKEN_RE.findall(fold_text(query)):
+        pos = folded.find(q)
+        if pos >= 0:
+            break
+    start = max(pos - HISTORY_SNIPPET_CHARS // 2, 0) if pos >= 0 else 0
+    snippet = text[start:start + HISTORY_SNIPPET_CHARS].replace("\n", " ")
+    prefix = "…" if start > 0 else ""
+    suffix = "…" if start + HISTORY_SNIPPET_CHARS < len(text) else ""
+    return prefix + snippet + suffix
+
 
 def append_conversation(user_id: int, role: str, text: str) -> None:
-    all_conv = load_conversations()
+    global _pending_turns
     uid = str(user_id)
-    all_conv.setdefault(uid, []).append(
+    conversations_cache().setdefault(uid, []).append(
         {
             "timestamp": datetime.utcnow().isoformat(),
             "role": role,
             "text": text,
         }
     )
-    save_conversations(all_conv)
+    _pending_turns += 1
+    _dirty_conversations.add(uid)
+    index = HISTORY_INDEXES.get(uid)
+    if index is not None:
+        index.add(text)
 
 
 # =====================================================
-# 5. AI – TERAPIJSKI MODOVI
+# 8. AI – TERAPIJSKI MODOVI
 # =====================================================
 
 THERAPY_PROMPTS: Dict[str, str] = {
@@ -205,53 +988,373 @@ THERAPY_PROMPTS: Dict[str, str] = {
 }
 
 
-async def ai_chat_reply(user: Dict[str, Any], text: str) -> str:
-    mode = user.get("therapy_mode", "NONE")
-    system_prompt = THERAPY_PROMPTS.get(mode, THERAPY_PROMPTS["NONE"])
+LLM_MODEL = "gpt-4o-mini"
 
-    try:
-        completion = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": text},
-            ],
+# ukupni rok (sekunde) po vrsti poziva – uključuje i ponovne pokušaje
+LLM_DEADLINES: Dict[str, float] = {
+    "chat": float(os.getenv("LLM_DEADLINE_CHAT", "25")),
+    "analysis": float(os.getenv("LLM_DEADLINE_ANALYSIS", "45")),
+    "challenge": float(os.getenv("LLM_DEADLINE_CHALLENGE", "15")),
+    "quiz": float(os.getenv("LLM_DEADLINE_QUIZ", "45")),
+}
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "4"))
+# hedging: ako odgovor kasni više od p95 dosadašnjih latencija, pošalji i drugi zahtjev
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") == "1"
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1.5"))
+LLM_HEDGE_MIN_SAMPLES = 20
+# circuit breaker
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET = float(os.getenv("LLM_BREAKER_RESET", "30"))
+
+RETRYABLE_ERRORS = (
+    APIConnectionError,       # uključuje i APITimeoutError
+    RateLimitError,
+    InternalServerError,
+    asyncio.TimeoutError,
+)
+
+# umjesto teksta greške korisnik dobiva smiren, unaprijed pripremljen odgovor
+FALLBACK_REPLIES: Dict[str, str] = {
+    "chat": (
+        "Trenutno imam poteškoća s odgovaranjem, ali i dalje sam tu. 💙 "
+        "Pokušaj mi ponovno pisati za nekoliko minuta. Dok čekaš, udahni polako "
+        "nekoliko puta i primijeti kako se tvoje tijelo osjeća. "
+        "Ako si u neposrednoj opasnosti, nazovi 112."
+    ),
+    "analysis": (
+        "Analiza emocija trenutno nije dostupna. Tvoji unosi su spremljeni – "
+        "pokušaj ponovno za nekoliko minuta."
+    ),
+    "quiz": (
+        "Objašnjenje rezultata trenutno nije dostupno. Tvoj rezultat je spremljen – "
+        "pokušaj ponovno za nekoliko minuta. Ako te simptomi muče, razgovaraj s liječnikom "
+        "obiteljske medicine ili psihologom."
+    ),
+}
+FALLBACK_CHALLENGES: List[str] = [
+    "Zapiši tri stvari na kojima si danas zahvalan/na, makar bile sasvim male.",
+    "Napravi pet sporih udaha: udah na 4, zadrži na 4, izdah na 6.",
+    "Pošalji kratku poruku nekome bliskom i pitaj kako je.",
+    "Prošetaj 10 minuta bez mobitela i primijeti tri stvari oko sebe.",
+]
+_FALLBACKS = set(FALLBACK_REPLIES.values()) | set(FALLBACK_CHALLENGES)
+
+
+def fallback_reply(feature: str) -> str:
+    if feature == "challenge":
+        return random.choice(FALLBACK_CHALLENGES)
+    return FALLBACK_REPLIES.get(feature, FALLBACK_REPLIES["chat"])
+
+
+def is_ai_failure(reply: str) -> bool:
+    return reply in _FALLBACKS
+
+
+class CircuitBreaker:
+    # closed → (N uzastopnih neuspjeha) → open → (nakon reset_timeout) → half_open (jedan probni poziv)
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self.rejected = 0
+        self._probe_inflight = False
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                self.rejected += 1
+                return False
+            self.state = "half_open"
+            self._probe_inflight = False
+        if self.state == "half_open":
+            if self._probe_inflight:
+                self.rejected += 1
+                return False
+            self._probe_inflight = True
+        return True
+
+    def record_success(self) -> None:
+        if self.state != "closed":
+            log_event("breaker", state="closed")
+        self.state = "closed"
+        self.failures = 0
+        self._probe_inflight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                self.opens += 1
+                log_event("breaker", state="open", failures=self.failures)
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self._probe_inflight = False
+
+    def release_probe(self) -> None:
+        # otkazani probni poziv ne smije zauvijek zaključati half_open
+        self._probe_inflight = False
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "opens": self.opens,
+            "rejected": self.rejected,
+        }
+
+
+class LLMStats:
+    __slots__ = ("calls", "retries", "hedges", "hedge_wins", "timeouts", "fallbacks", "latencies")
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+        self.fallbacks = 0
+        # zadnje uspješne latencije po vrsti poziva, za p95 hedging; ključevi unaprijed,
+        # jer snapshot() čita iz Flask dretve dok event loop dodaje latencije
+        self.latencies: Dict[str, Deque[float]] = {f: deque(maxlen=200) for f in LLM_DEADLINES}
+
+    def p95(self, feature: str) -> float | None:
+        window = self.latencies.get(feature)
+        if not window or len(window) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(window)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "timeouts": self.timeouts,
+            "fallbacks": self.fallbacks,
+            "p95_s": {f: self.p95(f) for f in list(self.latencies)},
+        }
+
+
+LLM_BREAKER = CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_RESET)
+LLM_STATS = LLMStats()
+
+
+async def _llm_request(messages: List[Dict[str, str]], timeout: float, hedge: bool = False):
+    with span("llm.request", hedge=hedge) as rec:
+        completion = await client.chat.completions.create(
+            model=LLM_MODEL,
+            messages=messages,
             max_tokens=900,
+            timeout=timeout,
         )
+        if completion.usage:
+            rec["tokens"] = completion.usage.total_tokens
+        return completion
+
+
+async def _hedged_request(feature: str, messages: List[Dict[str, str]], timeout: float):
+    ev_loop = asyncio.get_running_loop()
+    deadline = ev_loop.time() + timeout
+    primary = asyncio.ensure_future(_llm_request(messages, timeout))
+    tasks = {primary}
+    try:
+        delay = LLM_STATS.p95(feature) if LLM_HEDGE else None
+        if delay is not None:
+            delay = max(delay, LLM_HEDGE_MIN_DELAY)
+            if delay < timeout:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    LLM_STATS.hedges += 1
+                    remaining = deadline - ev_loop.time()
+                    tasks.add(asyncio.ensure_future(_llm_request(messages, remaining, hedge=True)))
+
+        last_exc: BaseException | None = None
+        while tasks:
+            remaining = deadline - ev_loop.time()
+            if remaining <= 0:
+                break
+            done, _ = await asyncio.wait(tasks, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            for t in done:
+                tasks.discard(t)
+                if t.exception() is None:
+                    if t is not primary:
+                        LLM_STATS.hedge_wins += 1
+                    return t.result()
+                last_exc = t.exception()
+        if last_exc is not None and not tasks:
+            raise last_exc
+        raise asyncio.TimeoutError()
+    finally:
+        for t in tasks:
+            t.cancel()
+
+
+async def ai_chat_reply(
+    user: UserRecord,
+    text: str,
+    feature: str = "chat",
+    system_prompt: str | None = None,
+) -> str:
+    # system_prompt zamjenjuje prompt terapijskog moda (npr. za odgovore zajedničke svim korisnicima)
+    mode = user.therapy_mode.value if system_prompt is None else "fixed"
+    if system_prompt is None:
+        system_prompt = THERAPY_PROMPTS.get(mode, THERAPY_PROMPTS["NONE"])
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": text},
+    ]
+
+    LLM_STATS.calls += 1
+    if not LLM_BREAKER.allow():
+        LLM_STATS.fallbacks += 1
+        return fallback_reply(feature)
+
+    ev_loop = asyncio.get_running_loop()
+    deadline = ev_loop.time() + LLM_DEADLINES.get(feature, LLM_DEADLINES["chat"])
+
+    HEALTH.inflight_llm += 1
+    try:
+        with span("llm.chat", model=LLM_MODEL, mode=mode, feature=feature) as rec:
+            attempt = 0
+            while True:
+                started = ev_loop.time()
+                try:
+                    completion = await _hedged_request(feature, messages, deadline - started)
+                    break
+                except RETRYABLE_ERRORS as e:
+                    if isinstance(e, asyncio.TimeoutError):
+                        LLM_STATS.timeouts += 1
+                    backoff = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+                    # ima li smisla još jedan pokušaj unutar roka
+                    if attempt >= LLM_MAX_RETRIES or ev_loop.time() + backoff >= deadline - 1:
+                        raise
+                    attempt += 1
+                    LLM_STATS.retries += 1
+                    await asyncio.sleep(backoff)
+            rec["attempts"] = attempt + 1
+
+        LLM_STATS.latencies.setdefault(feature, deque(maxlen=200)).append(ev_loop.time() - started)
+        LLM_BREAKER.record_success()
+        HEALTH.last_openai_ok = time.monotonic()
         return completion.choices[0].message.content
+    except asyncio.CancelledError:
+        LLM_BREAKER.release_probe()
+        raise
     except Exception as e:
-        return f"⚠️ Greška AI servisa: {e}"
+        logger.warning("AI poziv nije uspio (%s): %r", feature, e)
+        LLM_BREAKER.record_failure()
+        LLM_STATS.fallbacks += 1
+        return fallback_reply(feature)
+    finally:
+        HEALTH.inflight_llm -= 1
 
 
 # =====================================================
-# 6. DNEVNIK EMOCIJA I DNEVNA PROVJERA
+# 9. SINGLE-FLIGHT ZA SKUPE AKCIJE
 # =====================================================
 
-
-def add_mood_entry(user: Dict[str, Any], rating: int, note: str | None = None) -> None:
-    mood_log: List[Dict[str, Any]] = user.get("mood_log", [])
-    mood_log.append(
-        {
-            "timestamp": datetime.utcnow().strftime("%Y-%m-%d %H:%M"),
-            "rating": rating,
-            "note": note or "",
+SINGLE_FLIGHT_TTL = float(os.getenv("SINGLE_FLIGHT_TTL", "60"))
+
+
+class SingleFlight:
+    # isti ključ (akcija, korisnik…) = jedan LLM poziv; duplikati čekaju isti future,
+    # a gotov rezultat se još TTL sekundi vraća iz cachea
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self._inflight: Dict[Tuple[Any, ...], asyncio.Future] = {}
+        self._done: Dict[Tuple[Any, ...], Tuple[float, Any]] = {}
+        self.calls = 0
+        self.joined = 0
+        self.cached = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "calls": self.calls,
+            "joined": self.joined,
+            "cached": self.cached,
+            "saved": self.joined + self.cached,
+            "inflight": len(self._inflight),
         }
-    )
+
+    def _prune(self, now: float) -> None:
+        for key in [k for k, (exp, _) in self._done.items() if exp <= now]:
+            del self._done[key]
+
+    async def run(
+        self,
+        key: Tuple[Any, ...],
+        factory: Callable[[], Awaitable[Any]],
+        cache_if: Callable[[Any], bool] | None = None,
+    ) -> Tuple[Any, str]:
+        # vraća (rezultat, izvor) – izvor je "call", "joined" ili "cached"
+        now = time.monotonic()
+        hit = self._done.get(key)
+        if hit is not None and hit[0] > now:
+            self.cached += 1
+            return hit[1], "cached"
+
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.joined += 1
+            return await asyncio.shield(fut), "joined"
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        self.calls += 1
+        try:
+            result = await factory()
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as e:
+            fut.set_exception(e)
+            fut.exception()  # označi kao pročitano ako nitko ne čeka
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+        fut.set_result(result)
+        if len(self._done) > 1024:
+            self._prune(now)
+        if cache_if is None or cache_if(result):
+            self._done[key] = (time.monotonic() + self.ttl, result)
+        return result, "call"
+
+
+SINGLE_FLIGHT = SingleFlight(SINGLE_FLIGHT_TTL)
+
+
+# =====================================================
+# 10. DNEVNIK EMOCIJA I DNEVNA PROVJERA
+# =====================================================
+
+
+def add_mood_entry(user: UserRecord, rating: int, note: str | None = None) -> None:
+    user.mood_minutes.append(int(time.time() // 60))
+    user.mood_ratings.append(rating)
+    user.mood_notes.append(sys.intern(note or ""))
     # ograniči na zadnjih 90 unosa
-    if len(mood_log) > 90:
-        mood_log[:] = mood_log[-90:]
-    user["mood_log"] = mood_log
+    if len(user.mood_ratings) > MOOD_LOG_LIMIT:
+        del user.mood_minutes[:-MOOD_LOG_LIMIT]
+        del user.mood_ratings[:-MOOD_LOG_LIMIT]
+        del user.mood_notes[:-MOOD_LOG_LIMIT]
 
 
-async def send_emotion_analysis(chat_id: int, user: Dict[str, Any], context: ContextTypes.DEFAULT_TYPE) -> None:
-    log = user.get("mood_log", [])
-    if len(log) < 3:
+async def send_emotion_analysis(chat_id: int, user: UserRecord, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if len(user.mood_ratings) < 3:
         await context.bot.send_message(chat_id, "Za analizu treba barem 3 unosa u dnevnik emocija.")
         return
 
-    last = log[-21:]
     lines = [
-        f"{e['timestamp']}: {e['rating']} – {e.get('note','')[:80]}" for e in last
+        f"{ts}: {rating} – {note[:80]}" for ts, rating, note in user.mood_entries(21)
     ]
     joined = "\n".join(lines)
 
@@ -262,7 +1365,16 @@ async def send_emotion_analysis(chat_id: int, user: Dict[str, Any], context: Con
         "obrasce razmišljanja i predloži 3–5 konkretnih koraka za brigu o sebi."
     )
 
-    result = await ai_chat_reply(user, prompt)
+    # ključ uključuje stanje dnevnika – novi unos znači novu analizu
+    key = ("EMOTION_ANALYSIS", chat_id, len(user.mood_ratings), user.mood_minutes[-1])
+    result, source = await SINGLE_FLIGHT.run(
+        key,
+        lambda: ai_chat_reply(user, prompt, feature="analysis"),
+        cache_if=lambda r: not is_ai_failure(r),
+    )
+    if source == "joined":
+        # isti rezultat već šalje prvi dodir
+        return
     await context.bot.send_message(chat_id, "📊 *Analiza emocija:*\n\n" + result, parse_mode="Markdown")
 
 
@@ -270,7 +1382,7 @@ async def daily_check_job(context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = context.job.chat_id
     uid = str(chat_id)
     user = get_user_str(uid)
-    if not user or not user.get("daily_check"):
+    if not user or not user.daily_check:
         return
 
     keyboard = [
@@ -301,12 +1413,301 @@ def schedule_daily(app: Application, chat_id: int) -> None:
     )
 
 
+SCHEDULER_STATE_FILE = "scheduler_state.json"
+# provjera propuštena dok je bot bio ugašen (npr. redeploy u 20:00) šalje se nakon pokretanja
+MISSED_JOB_GRACE = timedelta(hours=float(os.getenv("MISSED_JOB_GRACE_HOURS", "1")))
+
+
+async def save_scheduler_state(app: Application) -> int:
+    jobs = [
+        {
+            "chat_id": job.chat_id,
+            "next_t": job.next_t.isoformat() if job.next_t else None,
+        }
+        for job in app.job_queue.jobs()
+        if job.name and job.name.startswith("daily_")
+    ]
+    await asyncio.to_thread(write_json_atomic, SCHEDULER_STATE_FILE, {"daily": jobs})
+    return len(jobs)
+
+
+def restore_scheduler_state(app: Application) -> int:
+    saved: List[Dict[str, Any]] = []
+    if os.path.exists(SCHEDULER_STATE_FILE):
+        with open(SCHEDULER_STATE_FILE, "r", encoding="utf-8") as f:
+            saved = json.load(f).get("daily", [])
+
+    # izvor istine je daily_check u korisnicima; datoteka čuva vrijeme sljedećeg okidanja
+    chat_ids = {int(uid) for uid, u in users_cache().items() if u.daily_check}
+    now = datetime.now(timezone.utc)
+    for entry in saved:
+        chat_id = entry.get("chat_id")
+        if chat_id not in chat_ids or not entry.get("next_t"):
+            continue
+        next_t = datetime.fromisoformat(entry["next_t"])
+        if next_t < now and now - next_t <= MISSED_JOB_GRACE:
+            app.job_queue.run_once(daily_check_job, when=5, chat_id=chat_id, name=f"missed_{chat_id}")
+
+    for chat_id in chat_ids:
+        if not app.job_queue.get_jobs_by_name(f"daily_{chat_id}"):
+            schedule_daily(app, chat_id)
+    return len(chat_ids)
+
+
 # =====================================================
-# 7. GLAVNI MENI
+# 11. KRIZNI SIGNALI – LOKALNO, BEZ LLM-a
 # =====================================================
 
+# CRISIS_LEXICON_FILE – jedna fraza po retku (# = komentar); zamjenjuje ugrađeni popis.
+# Svaka riječ fraze uspoređuje se kao početak riječi ("samoubo" → samoubojstvo, samoubojica…),
+# a riječi kraće od 4 slova moraju se poklopiti cijele ("pod" ≠ "podne").
+# Klitike (ću, bih, sam, da…) izbacuju se i iz teksta i iz fraza, a između riječi
+# fraze smiju stajati još najviše dvije riječi ("ne želim živj" → "ne želim nikad više živjeti").
+# Fraza sa "se" traži povratnu zamjenicu u blizini, bilo ispred ili iza glagola:
+# "ubit se" pogađa "želim se ubiti", "ubiti ću se" i "htio bih se ubiti".
+CRISIS_LEXICON_FILE = os.getenv("CRISIS_LEXICON_FILE")
+
+DEFAULT_CRISIS_LEXICON: List[str] = [
+    "samoubo",
+    "samoubij",
+    "samoubil",
+    "suicid",
+    "ubit se",
+    "ubijem se",
+    "ubiješ se",
+    "ubijam se",
+    "ubio se",
+    "ubila se",
+    "oduzet si život",
+    "oduzmem si život",
+    "okončat život",
+    "želim umri",
+    "želim umrem",
+    "poželim umri",
+    "poželim umrem",
+    "hoću umri",
+    "hoću umrem",
+    "htio bih umri",
+    "htjela bih umri",
+    "ne želim živj",
+    "ne želim živi",
+    "ne želim živim",
+    "nema smisla živj",
+    "nema smisla živi",
+    "nemam za što živj",
+    "nemam razloga živj",
+    "nemam razloga živi",
+    "bolje da me nema",
+    "bolje bi bilo da me nema",
+    "želim nestati",
+    "zaspat zauvijek",
+    "samoozljeđ",
+    "ozlijedit se",
+    "ozlijedim se",
+    "ozlijedio se",
+    "ozlijedila se",
+    "ozljeđujem se",
+    "ozljeđivat se",
+    "režem se",
+    "rezat se",
+    "rezala se",
+    "rezao se",
+    "porezat se",
+    "porežem se",
+    "porezala se",
+    "porezao se",
+    "predozir",
+    "objesit se",
+    "objesim se",
+    "objesio se",
+    "objesila se",
+    "skočit s mosta",
+    "skočit s zgrade",
+    "skočit s krova",
+    "skočit pod vlak",
+    "bacit se pod vlak",
+    "bacit se pod auto",
+    "kraj svemu",
+]
+
+CRISIS_REPLY = (
+    "💙 Žao mi je što prolaziš kroz ovo. Tvoj život je važan i ne moraš ovo nositi sam/a.\n\n"
+    "Ako si u neposrednoj opasnosti, odmah nazovi *112* ili otiđi na najbližu hitnu službu.\n\n"
+    "Možeš razgovarati i s ljudima koji su tu upravo za ovo:\n"
+    "• Plavi telefon: 01 4833 888\n"
+    "• Psihološki centar TESA: 01 4828 888\n"
+    "• Centar za krizna stanja KBC Zagreb: 01 2376 470\n"
+    "• Hrabri telefon (djeca i mladi): 116 111\n\n"
+    "Ja sam i dalje tu – napiši mi kako se osjećaš upravo sada."
+)
+
 
-def build_main_menu(user: Dict[str, Any]) -> InlineKeyboardMarkup:
+# pomoćni glagoli i nenaglašene zamjenice koje mogu stajati bilo gdje oko glagola
+CRISIS_CLITICS = frozenset({
+    "cu", "ces", "ce", "cemo", "cete",
+    "bih", "bi", "bismo", "biste",
+    "sam", "si", "je", "smo", "ste", "su",
+    "da",
+})
+CRISIS_REFLEXIVES = frozenset({"se", "sebe"})
+# koliko riječi dalje smije biti sljedeća riječ fraze, odnosno "se" od glagola
+# ("ne želim nikad više živjeti", "da ću se ubiti", "ubit ću se")
+CRISIS_WORD_WINDOW = 3
+CRISIS_PREFIX_MIN = 4
+
+
+def crisis_tokens(text: str) -> Tuple[List[str], List[int], List[int]]:
+    # vraća (riječi bez klitika, njihov indeks u izvornom nizu riječi, indeksi povratnih zamjenica)
+    words: List[str] = []
+    positions: List[int] = []
+    reflexives: List[int] = []
+    for i, t in enumerate(tokenize(text)):
+        if t in CRISIS_REFLEXIVES:
+            reflexives.append(i)
+        elif t not in CRISIS_CLITICS:
+            words.append(t)
+            positions.append(i)
+    return words, positions, reflexives
+
+
+def compile_crisis_pattern(phrase: str) -> Tuple[List[str], bool] | None:
+    # vraća (riječi fraze, traži li fraza povratnu zamjenicu)
+    words, _, reflexives = crisis_tokens(phrase)
+    if not words:
+        return None
+    return words, bool(reflexives)
+
+
+class PhraseMatcher:
+    # svaka riječ teksta jednom se potraži u rječniku (cijela i njeni prefiksi),
+    # a fraze se slažu od pogođenih riječi uz dopušteni razmak
+    def __init__(self, phrases: List[str]) -> None:
+        self.phrases: List[str] = []
+        self.patterns: List[List[int]] = []      # fraza → id-jevi riječi
+        self.reflexive: List[bool] = []
+        self.exact: Dict[str, int] = {}          # riječ kraća od CRISIS_PREFIX_MIN → id
+        self.prefix: Dict[str, int] = {}         # početak riječi → id
+        self.by_first: Dict[int, List[int]] = {}  # id prve riječi → fraze
+        self.max_prefix = 0
+
+        for phrase in phrases:
+            compiled = compile_crisis_pattern(phrase)
+            if compiled is None:
+                continue
+            words, reflexive = compiled
+            ids: List[int] = []
+            for w in words:
+                table = self.prefix if len(w) >= CRISIS_PREFIX_MIN else self.exact
+                wid = table.get(w)
+                if wid is None:
+                    wid = table[w] = len(self.exact) + len(self.prefix)
+                ids.append(wid)
+            self.by_first.setdefault(ids[0], []).append(len(self.phrases))
+            self.phrases.append(phrase)
+            self.patterns.append(ids)
+            self.reflexive.append(reflexive)
+        self.max_prefix = max(map(len, self.prefix), default=0)
+
+    def _word_ids(self, word: str) -> set[int]:
+        ids: set[int] = set()
+        wid = self.exact.get(word)
+        if wid is not None:
+            ids.add(wid)
+        for n in range(CRISIS_PREFIX_MIN, min(len(word), self.max_prefix) + 1):
+            wid = self.prefix.get(word[:n])
+            if wid is not None:
+                ids.add(wid)
+        return ids
+
+    def _extend(self, hits: List[set[int]], pattern: List[int], k: int, pos: int) -> int | None:
+        # indeks zadnje riječi ako se ostatak fraze (od k-te riječi) može složiti iza pos
+        if k == len(pattern):
+            return pos
+        for j in range(pos + 1, min(pos + 1 + CRISIS_WORD_WINDOW, len(hits))):
+            if pattern[k] in hits[j]:
+                end = self._extend(hits, pattern, k + 1, j)
+                if end is not None:
+                    return end
+        return None
+
+    def first_match(self, text: str) -> str | None:
+        words, positions, reflexives = crisis_tokens(text)
+        hits = [self._word_ids(w) for w in words]
+        for i, ids in enumerate(hits):
+            for wid in ids:
+                for idx in self.by_first.get(wid, ()):
+                    end = self._extend(hits, self.patterns[idx], 1, i)
+                    if end is None:
+                        continue
+                    if not self.reflexive[idx]:
+                        return self.phrases[idx]
+                    # "se" mora biti blizu pogođenih riječi u izvornom tekstu
+                    lo = positions[i] - CRISIS_WORD_WINDOW
+                    hi = positions[end] + CRISIS_WORD_WINDOW
+                    j = bisect.bisect_left(reflexives, lo)
+                    if j < len(reflexives) and reflexives[j] <= hi:
+                        return self.phrases[idx]
+        return None
+
+
+def load_crisis_lexicon() -> List[str]:
+    if not CRISIS_LEXICON_FILE:
+        return DEFAULT_CRISIS_LEXICON
+    with open(CRISIS_LEXICON_FILE, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+CRISIS_MATCHER = PhraseMatcher(load_crisis_lexicon())
+
+
+def detect_crisis(text: str) -> str | None:
+    return CRISIS_MATCHER.first_match(text)
+
+
+def flag_for_review(
+    context: ContextTypes.DEFAULT_TYPE,
+    user_id: int,
+    user: UserRecord,
+    reason: str,
+    text: str,
+) -> None:
+    user.crisis_flagged = datetime.utcnow().isoformat()
+    save_user(user_id, user)
+    log_event("crisis", user_id=user_id, reason=reason)
+
+    if ADMIN_ID:
+        # obavijest adminu ne smije usporiti odgovor korisniku
+        context.application.create_task(
+            context.bot.send_message(
+                ADMIN_ID,
+                f"🚨 Krizni signal: {user.name} ({user_id})\n"
+                f"Razlog: {reason}\n\n{text[:300]}\n\n/flagged – popis označenih",
+            )
+        )
+
+
+async def handle_crisis(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    user: UserRecord,
+    text: str,
+    phrase: str,
+) -> None:
+    user_id = update.effective_user.id
+    with span("crisis.reply"):
+        await update.message.reply_text(CRISIS_REPLY, parse_mode="Markdown")
+
+    append_conversation(user_id, "user", text)
+    append_conversation(user_id, "bot", CRISIS_REPLY)
+    flag_for_review(context, user_id, user, f"fraza „{phrase}“", text)
+
+
+# =====================================================
+# 12. GLAVNI MENI
+# =====================================================
+
+
+def build_main_menu(user: UserRecord) -> InlineKeyboardMarkup:
     kb: List[List[InlineKeyboardButton]] = [
         [InlineKeyboardButton("💬 Počni razgovor", callback_data="CHAT_START")],
         [
@@ -321,15 +1722,18 @@ def build_main_menu(user: Dict[str, Any]) -> InlineKeyboardMarkup:
             InlineKeyboardButton("🎲 Dnevni izazov", callback_data="DAILY_CHALLENGE"),
             InlineKeyboardButton("⭐ Premium info", callback_data="PREMIUM_INFO"),
         ],
-        [InlineKeyboardButton("ℹ️ Pomoć", callback_data="HELP_MENU")],
+        [
+            InlineKeyboardButton("🧪 Psihološki testovi", callback_data="TEST_MENU"),
+            InlineKeyboardButton("ℹ️ Pomoć", callback_data="HELP_MENU"),
+        ],
     ]
     return InlineKeyboardMarkup(kb)
 
 
-def main_menu_text(user: Dict[str, Any]) -> str:
-    mode = user.get("therapy_mode", "NONE")
-    mode_txt = "isključen" if mode == "NONE" else mode
-    premium_txt = "DA" if user.get("premium") else "NE"
+def main_menu_text(user: UserRecord) -> str:
+    mode = user.therapy_mode
+    mode_txt = "isključen" if mode is TherapyMode.NONE else mode.value
+    premium_txt = "DA" if user.premium else "NE"
     return (
         "🤖 *Psiholog Bot – glavni izbornik*\n\n"
         f"⭐ Premium: {premium_txt}\n"
@@ -338,7 +1742,7 @@ def main_menu_text(user: Dict[str, Any]) -> str:
     )
 
 
-async def send_main_menu(chat_id: int, user: Dict[str, Any], context: ContextTypes.DEFAULT_TYPE) -> None:
+async def send_main_menu(chat_id: int, user: UserRecord, context: ContextTypes.DEFAULT_TYPE) -> None:
     await context.bot.send_message(
         chat_id,
         main_menu_text(user),
@@ -347,7 +1751,7 @@ async def send_main_menu(chat_id: int, user: Dict[str, Any], context: ContextTyp
     )
 
 
-async def edit_to_main_menu(query, user: Dict[str, Any]) -> None:
+async def edit_to_main_menu(query, user: UserRecord) -> None:
     await query.edit_message_text(
         main_menu_text(user),
         reply_markup=build_main_menu(user),
@@ -355,6 +1759,15 @@ async def edit_to_main_menu(query, user: Dict[str, Any]) -> None:
     )
 
 
+async def safe_edit(query, text: str, **kwargs) -> None:
+    # dvostruki dodir uređuje poruku na isti tekst – Telegram to javlja kao grešku
+    try:
+        await query.edit_message_text(text, **kwargs)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+
+
 def back_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         [[InlineKeyboardButton("⬅️ Glavni meni", callback_data="BACK_MAIN")]]
@@ -362,7 +1775,275 @@ def back_keyboard() -> InlineKeyboardMarkup:
 
 
 # =====================================================
-# 8. KOMANDE
+# 13. PSIHOLOŠKI TESTOVI (PHQ-9, GAD-7) – LOKALNO BODOVANJE
+# =====================================================
+
+TEST_LOG_LIMIT = 52
+
+QUIZ_OPTIONS: List[str] = ["Nimalo", "Nekoliko dana", "Više od pola dana", "Gotovo svaki dan"]
+
+
+class Questionnaire:
+    __slots__ = ("code", "title", "intro", "items", "band_limits", "band_labels", "band_labels_acc", "risk_item")
+
+    def __init__(
+        self,
+        code: str,
+        title: str,
+        intro: str,
+        items: List[str],
+        bands: List[Tuple[int, str, str]],
+        risk_item: int | None = None,
+    ) -> None:
+        self.code = code
+        self.title = title
+        self.intro = intro
+        self.items = items
+        self.band_limits = [limit for limit, _, _ in bands]   # gornje granice, uključivo
+        # uz imenicu "razina": nominativ za prikaz, akuzativ za prompt ("pokazuje blagu razinu")
+        self.band_labels = [label for _, label, _ in bands]
+        self.band_labels_acc = [label for _, _, label in bands]
+        self.risk_item = risk_item                          # pitanje koje traži krizni odgovor
+
+    def band(self, score: int) -> int:
+        return bisect.bisect_left(self.band_limits, score)
+
+
+QUESTIONNAIRES: Dict[str, Questionnaire] = {
+    "PHQ9": Questionnaire(
+        "PHQ9",
+        "PHQ-9 (raspoloženje)",
+        "Koliko su te često u posljednja 2 tjedna mučili sljedeći problemi?",
+        [
+            "Slab interes ili malo zadovoljstva u obavljanju stvari",
+            "Osjećaj potištenosti, depresivnosti ili beznađa",
+            "Teškoće s usnivanjem ili spavanjem, ili previše spavanja",
+            "Osjećaj umora ili nedostatka energije",
+            "Slab apetit ili prejedanje",
+            "Loše mišljenje o sebi – osjećaj da si neuspješan/na ili da si iznevjerio/la sebe ili obitelj",
+            "Teškoće s koncentracijom, npr. pri čitanju ili gledanju televizije",
+            "Usporenost u kretanju ili govoru koju su drugi mogli primijetiti – ili suprotno, nemir veći nego inače",
+            "Misli da bi ti bilo bolje da si mrtav/a ili da se na neki način ozlijediš",
+        ],
+        [
+            (4, "minimalna", "minimalnu"),
+            (9, "blaga", "blagu"),
+            (14, "umjerena", "umjerenu"),
+            (19, "umjereno teška", "umjereno tešku"),
+            (27, "teška", "tešku"),
+        ],
+        risk_item=8,
+    ),
+    "GAD7": Questionnaire(
+        "GAD7",
+        "GAD-7 (anksioznost)",
+        "Koliko su te često u posljednja 2 tjedna mučili sljedeći problemi?",
+        [
+            "Osjećaj nervoze, tjeskobe ili napetosti",
+            "Nemogućnost zaustavljanja ili kontroliranja brige",
+            "Pretjerana briga oko različitih stvari",
+            "Teškoće s opuštanjem",
+            "Toliki nemir da je teško mirno sjediti",
+            "Lako se iznerviraš ili razdražiš",
+            "Strah kao da bi se moglo dogoditi nešto strašno",
+        ],
+        [
+            (4, "minimalna", "minimalnu"),
+            (9, "blaga", "blagu"),
+            (14, "umjerena", "umjerenu"),
+            (21, "teška", "tešku"),
+        ],
+    ),
+}
+
+
+class QuizSession:
+    __slots__ = ("code", "answers")
+
+    def __init__(self, code: str) -> None:
+        self.code = code
+        self.answers = bytearray()
+
+
+# sesija traje samo dok se test ispunjava – ne sprema se na disk
+QUIZ_SESSIONS: Dict[int, QuizSession] = {}
+# objašnjenje ovisi samo o testu i rasponu bodova, pa se LLM pita jednom po rasponu
+QUIZ_NARRATIVES: Dict[Tuple[str, int], str] = {}
+# dijeli se među korisnicima, pa ne smije ovisiti o terapijskom modu onoga tko ga je prvi zatražio
+QUIZ_SYSTEM_PROMPT = (
+    "Ti si empatičan psihološki asistent koji objašnjava rezultate standardiziranih upitnika. "
+    "Ne postavljaš dijagnozu, pišeš neutralno i razumljivo, na hrvatskom jeziku."
+)
+
+
+def add_test_result(user: UserRecord, code: str, score: int) -> None:
+    if user.test_log is None:
+        user.test_log = {}
+    minutes, scores = user.test_log.setdefault(code, (array("i"), array("b")))
+    minutes.append(int(time.time() // 60))
+    scores.append(score)
+    if len(scores) > TEST_LOG_LIMIT:
+        del minutes[:-TEST_LOG_LIMIT]
+        del scores[:-TEST_LOG_LIMIT]
+
+
+def test_menu_keyboard() -> InlineKeyboardMarkup:
+    kb = [[InlineKeyboardButton(q.title, callback_data=f"QUIZ_START_{q.code}")] for q in QUESTIONNAIRES.values()]
+    kb.append([InlineKeyboardButton("📈 Moji rezultati", callback_data="QUIZ_HISTORY")])
+    kb.append([InlineKeyboardButton("⬅️ Glavni meni", callback_data="BACK_MAIN")])
+    return InlineKeyboardMarkup(kb)
+
+
+TEST_MENU_TEXT = (
+    "🧪 *Psihološki testovi*\n\n"
+    "Kratki upitnici za samoprocjenu. Rezultat nije dijagnoza, "
+    "ali može pomoći da pratiš kako se mijenjaš kroz vrijeme."
+)
+
+
+def quiz_question(session: QuizSession) -> Tuple[str, InlineKeyboardMarkup]:
+    q = QUESTIONNAIRES[session.code]
+    idx = len(session.answers)
+    text = (
+        f"🧪 *{q.title}* – pitanje {idx + 1}/{len(q.items)}\n\n"
+        f"{q.intro}\n\n*{q.items[idx]}*"
+    )
+    kb = [
+        [InlineKeyboardButton(label, callback_data=f"QUIZ_ANS_{q.code}_{idx}_{value}")]
+        for value, label in enumerate(QUIZ_OPTIONS)
+    ]
+    kb.append([InlineKeyboardButton("✖️ Prekini test", callback_data="TEST_MENU")])
+    return text, InlineKeyboardMarkup(kb)
+
+
+def quiz_result_text(q: Questionnaire, user: UserRecord, score: int, band: int) -> str:
+    lines = [
+        f"🧪 *{q.title}* – rezultat: *{score}* / {3 * len(q.items)}",
+        f"Razina simptoma: *{q.band_labels[band]}*",
+    ]
+    scores = user.test_log[q.code][1] if user.test_log and q.code in user.test_log else None
+    if scores is not None and len(scores) >= 2:
+        delta = scores[-1] - scores[-2]
+        trend = "bez promjene" if delta == 0 else f"{delta:+d} u odnosu na prošli put"
+        lines.append(f"Trend: {trend}")
+    lines.append("\nOvo je samoprocjena, a ne dijagnoza.")
+    return "\n".join(lines)
+
+
+def quiz_history_text(user: UserRecord) -> str:
+    if not user.test_log:
+        return "Još nemaš spremljenih rezultata testova."
+    lines = ["📈 *Tvoji rezultati*"]
+    for code, (minutes, scores) in user.test_log.items():
+        q = QUESTIONNAIRES.get(code)
+        if q is None or not scores:
+            continue
+        lines.append(f"\n*{q.title}*")
+        for i in range(max(len(scores) - 5, 0), len(scores)):
+            when = (EPOCH + timedelta(minutes=minutes[i])).strftime("%Y-%m-%d")
+            lines.append(f"{when}: {scores[i]} ({q.band_labels[q.band(scores[i])]})")
+    return "\n".join(lines)
+
+
+async def handle_quiz_button(query, data: str, user_id: int, user: UserRecord, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if data.startswith("QUIZ_START_"):
+        code = data.replace("QUIZ_START_", "")
+        if code not in QUESTIONNAIRES:
+            await query.edit_message_text("Nepoznat test.", reply_markup=back_keyboard())
+            return
+        session = QUIZ_SESSIONS[user_id] = QuizSession(code)
+        text, markup = quiz_question(session)
+        await query.edit_message_text(text, reply_markup=markup, parse_mode="Markdown")
+        return
+
+    if data.startswith("QUIZ_ANS_"):
+        try:
+            code, idx_raw, value_raw = data.replace("QUIZ_ANS_", "").split("_")
+            idx, value = int(idx_raw), int(value_raw)
+        except ValueError:
+            return
+        session = QUIZ_SESSIONS.get(user_id)
+        # zastarjeli ili dvostruki dodir – pitanje je već odgovoreno
+        if session is None or session.code != code or len(session.answers) != idx or not 0 <= value <= 3:
+            return
+        session.answers.append(value)
+
+        q = QUESTIONNAIRES[code]
+        if len(session.answers) < len(q.items):
+            text, markup = quiz_question(session)
+            await query.edit_message_text(text, reply_markup=markup, parse_mode="Markdown")
+            return
+
+        del QUIZ_SESSIONS[user_id]
+        score = sum(session.answers)
+        band = q.band(score)
+        add_test_result(user, code, score)
+        save_user(user_id, user)
+        log_event("quiz", user_id=user_id, test=code, score=score, band=band)
+
+        text = quiz_result_text(q, user, score, band)
+        if q.risk_item is not None and session.answers[q.risk_item] > 0:
+            text += "\n\n" + CRISIS_REPLY
+            flag_for_review(context, user_id, user, f"{q.title}, pitanje {q.risk_item + 1}", "")
+
+        kb = [
+            [InlineKeyboardButton("🧠 Objašnjenje rezultata", callback_data=f"QUIZ_EXPLAIN_{code}_{band}")],
+            [InlineKeyboardButton("🧪 Testovi", callback_data="TEST_MENU")],
+            [InlineKeyboardButton("⬅️ Glavni meni", callback_data="BACK_MAIN")],
+        ]
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode="Markdown")
+        return
+
+    if data.startswith("QUIZ_EXPLAIN_"):
+        try:
+            code, band_raw = data.replace("QUIZ_EXPLAIN_", "").split("_")
+            band = int(band_raw)
+            q = QUESTIONNAIRES[code]
+            label = q.band_labels[band]
+        except (ValueError, KeyError, IndexError):
+            return
+
+        narrative = QUIZ_NARRATIVES.get((code, band))
+        if narrative is None:
+            prompt = (
+                f"Korisnik je riješio upitnik {q.title} i rezultat pokazuje {q.band_labels_acc[band]} "
+                "razinu simptoma. Objasni u 4–6 rečenica, toplo i bez dijagnosticiranja, "
+                "što takav rezultat općenito znači i predloži 2–3 konkretna sljedeća koraka "
+                "(uključujući kada je dobro potražiti stručnu pomoć)."
+            )
+            narrative, _ = await SINGLE_FLIGHT.run(
+                ("QUIZ_EXPLAIN", code, band),
+                lambda: ai_chat_reply(user, prompt, feature="quiz", system_prompt=QUIZ_SYSTEM_PROMPT),
+                cache_if=lambda r: not is_ai_failure(r),
+            )
+            if not is_ai_failure(narrative):
+                QUIZ_NARRATIVES[(code, band)] = narrative
+
+        await safe_edit(
+            query,
+            f"🧠 *{q.title} – {label} razina*\n\n{narrative}",
+            parse_mode="Markdown",
+            reply_markup=InlineKeyboardMarkup(
+                [[InlineKeyboardButton("🧪 Testovi", callback_data="TEST_MENU")],
+                 [InlineKeyboardButton("⬅️ Glavni meni", callback_data="BACK_MAIN")]]
+            ),
+        )
+        return
+
+    if data == "QUIZ_HISTORY":
+        await query.edit_message_text(
+            quiz_history_text(user),
+            parse_mode="Markdown",
+            reply_markup=InlineKeyboardMarkup(
+                [[InlineKeyboardButton("🧪 Testovi", callback_data="TEST_MENU")],
+                 [InlineKeyboardButton("⬅️ Glavni meni", callback_data="BACK_MAIN")]]
+            ),
+        )
+        return
+
+
+# =====================================================
+# 14. KOMANDE
 # =====================================================
 
 
@@ -371,6 +2052,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     name = update.effective_user.full_name
     user = get_or_create_user(user_id, name)
 
+    if not user.approved:
+        await update.message.reply_text(NOT_APPROVED_TEXT)
+        return
+
     if not is_subscription_active(user):
         await update.message.reply_text(
             "⚠️ Tvoja probna pretplata je istekla. Javi se administratoru za nastavak."
@@ -393,7 +2078,8 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "/profile – (opcionalno) kratka forma o tebi (još u izradi)\n"
         "/menu ili /meni – prikaži glavni izbornik\n"
         "/mood – brzi unos raspoloženja (1–5 + bilješka)\n"
-        "/history – (opcionalno) arhiva razgovora (osnovna verzija)\n"
+        "/history [pojam] – arhiva razgovora i pretraga po pojmu\n"
+        "/tests – psihološki testovi (PHQ-9, GAD-7)\n"
         "\nVećinu vremena dovoljno je koristiti glavni meni."
     )
     await update.message.reply_text(text, parse_mode="Markdown")
@@ -407,14 +2093,13 @@ async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         await update.message.reply_text("Nisi registriran. Pošalji /start.")
         return
 
-    expiry_str = user.get("subscription_until")
-    if not expiry_str:
+    if user.subscription_until == INVALID_DATE_ORDINAL:
         await update.message.reply_text("⚠️ Problem s pretplatom. Javite se administratoru.")
         return
 
-    expiry = datetime.strptime(expiry_str, "%Y-%m-%d")
-    days_left = (expiry.date() - datetime.utcnow().date()).days
-    premium_flag = "DA" if user.get("premium") else "NE"
+    expiry_str = user.subscription_until_str
+    days_left = user.subscription_until - today_ordinal()
+    premium_flag = "DA" if user.premium else "NE"
 
     await update.message.reply_text(
         f"📅 Pretplata vrijedi do: {expiry_str}\n"
@@ -434,6 +2119,10 @@ async def menu_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     name = update.effective_user.full_name
     user = get_or_create_user(user_id, name)
 
+    if not user.approved:
+        await update.message.reply_text(NOT_APPROVED_TEXT)
+        return
+
     if not is_subscription_active(user):
         await update.message.reply_text("⚠️ Tvoja pretplata je istekla.")
         return
@@ -461,16 +2150,57 @@ async def mood_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
 
+# zadnja pretraga po korisniku – za gumbe "sljedeća stranica"
+HISTORY_SEARCHES: Dict[str, Tuple[str, List[int]]] = {}
+
+
+def render_history_page(uid: str, query: str, hits: List[int], page: int) -> Tuple[str, InlineKeyboardMarkup | None]:
+    conv = conversations_cache().get(uid, [])
+    pages = max((len(hits) + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE, 1)
+    page = min(max(page, 0), pages - 1)
+
+    lines = [f"🔎 „{query}“ – rezultata: {len(hits)} (stranica {page + 1}/{pages})", ""]
+    for idx in hits[page * HISTORY_PAGE_SIZE:(page + 1) * HISTORY_PAGE_SIZE]:
+        turn = conv[idx]
+        who = "🧑" if turn.get("role") == "user" else "🤖"
+        when = turn.get("timestamp", "")[:16].replace("T", " ")
+        lines.append(f"{when} {who} {history_snippet(turn.get('text', ''), query)}")
+
+    buttons: List[InlineKeyboardButton] = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("⬅️ Prethodna", callback_data=f"HIST_PAGE_{page - 1}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("➡️ Sljedeća", callback_data=f"HIST_PAGE_{page + 1}"))
+    return "\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
+
 async def history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     uid = str(update.effective_chat.id)
-    conv = load_conversations().get(uid, [])
+    conv = conversations_cache().get(uid, [])
     if not conv:
         await update.message.reply_text("Nema spremljene povijesti razgovora.")
         return
 
-    last = conv[-10:]
-    lines = [f"{c['timestamp']}: {c['role']}: {c['text'][:80]}" for c in last]
-    await update.message.reply_text("📜 Zadnji dijelovi razgovora:\n\n" + "\n".join(lines))
+    if not context.args:
+        last = conv[-10:]
+        lines = [f"{c['timestamp']}: {c['role']}: {c['text'][:80]}" for c in last]
+        await update.message.reply_text(
+            "📜 Zadnji dijelovi razgovora:\n\n" + "\n".join(lines)
+            + "\n\nZa pretragu: /history <pojam>"
+        )
+        return
+
+    query = " ".join(context.args)[:100]
+    with span("history.search") as rec:
+        hits = history_index(uid).search(query)
+        rec["hits"] = len(hits)
+    if not hits:
+        await update.message.reply_text(f"Nema rezultata za „{query}“.")
+        return
+
+    HISTORY_SEARCHES[uid] = (query, hits)
+    text, markup = render_history_page(uid, query, hits, 0)
+    await update.message.reply_text(text, reply_markup=markup)
 
 
 async def weekly_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -481,12 +2211,181 @@ async def weekly_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 
 async def tests_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(
-        "Psihološki testovi (PHQ-9, GAD-7 i slično) bit će dodani u sljedećoj verziji."
+        TEST_MENU_TEXT, reply_markup=test_menu_keyboard(), parse_mode="Markdown"
+    )
+
+
+def is_admin(user_id: int) -> bool:
+    return bool(ADMIN_ID) and user_id == ADMIN_ID
+
+
+async def pending_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # admin: korisnici koji čekaju odobrenje
+    if not is_admin(update.effective_user.id):
+        return
+
+    pending = [
+        f"{uid} – {u.name}" for uid, u in users_cache().items() if not u.approved or u.waiting
+    ]
+    if not pending:
+        await update.message.reply_text("Nema korisnika na čekanju.")
+        return
+
+    await update.message.reply_text("Korisnici na čekanju:\n" + "\n".join(pending))
+
+
+async def approve_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin(update.effective_user.id):
+        return
+
+    args = context.args
+    if len(args) != 1:
+        await update.message.reply_text("Upišite user ID: /approve <id>")
+        return
+
+    uid = args[0]
+    user = get_user_str(uid)
+    if not user:
+        await update.message.reply_text("Korisnik ne postoji.")
+        return
+
+    user.approved = True
+    user.waiting = False
+    _dirty_users.add(uid)
+    await update.message.reply_text(f"Korisnik {uid} je odobren.")
+
+
+async def flagged_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # admin: korisnici s kriznim signalom koji čekaju pregled
+    if not is_admin(update.effective_user.id):
+        return
+
+    flagged = sorted(
+        ((u.crisis_flagged, uid, u.name) for uid, u in users_cache().items() if u.crisis_flagged),
+        reverse=True,
+    )
+    if not flagged:
+        await update.message.reply_text("Nema označenih korisnika.")
+        return
+
+    lines = [f"{ts[:16].replace('T', ' ')} – {uid} – {name}" for ts, uid, name in flagged]
+    await update.message.reply_text(
+        "🚨 Krizni signali (najnoviji prvi):\n" + "\n".join(lines) + "\n\nPregledano: /unflag <id>"
+    )
+
+
+async def unflag_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin(update.effective_user.id):
+        return
+
+    if len(context.args) != 1:
+        await update.message.reply_text("Upišite user ID: /unflag <id>")
+        return
+
+    uid = context.args[0]
+    user = get_user_str(uid)
+    if not user or not user.crisis_flagged:
+        await update.message.reply_text("Korisnik nije označen.")
+        return
+
+    user.crisis_flagged = None
+    _dirty_users.add(uid)
+    await update.message.reply_text(f"Oznaka za {uid} je uklonjena.")
+
+
+async def slow_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # admin: /slow – popis sporih updateova, /slow <trace_id> – svi spanovi
+    if not is_admin(update.effective_user.id):
+        return
+
+    if context.args:
+        trace_id = context.args[0]
+        for t in SLOW_TRACES:
+            if t["trace_id"] == trace_id:
+                detail = json.dumps(t, ensure_ascii=False, indent=1, default=str)
+                await update.message.reply_text(detail[:4000])
+                return
+        await update.message.reply_text("Trace nije pronađen (možda je već izbačen iz buffera).")
+        return
+
+    if not SLOW_TRACES:
+        await update.message.reply_text(f"Nema sporih updateova (prag {SLOW_UPDATE_MS:.0f} ms).")
+        return
+
+    lines = [
+        f"{t['at'][11:19]} {t['trace_id']} {t['ms']:.0f} ms – {t.get('kind', '?')}"
+        for t in list(SLOW_TRACES)[-20:][::-1]
+    ]
+    await update.message.reply_text(
+        f"🐢 Spori updateovi (> {SLOW_UPDATE_MS:.0f} ms):\n\n" + "\n".join(lines)
+        + "\n\nDetalji: /slow <trace_id>"
     )
 
 
+async def profiler_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # admin: /profiler <sekunde> | /profiler stop | /profiler every <n>
+    global PROFILE_EVERY_N
+    if not is_admin(update.effective_user.id):
+        return
+
+    args = context.args
+    chat_id = update.effective_chat.id
+
+    if not args:
+        state = "uzorkuje" if _active_profiler else "miruje"
+        await update.message.reply_text(
+            f"🔬 Profiler {state}. Svaki n-ti update: {PROFILE_EVERY_N or 'isključeno'}.\n"
+            "/profiler <sekunde> – uzorkuj sve dretve\n"
+            "/profiler stop – prekini uzorkovanje\n"
+            "/profiler every <n> – uzorkuj svaki n-ti update (0 = isključi)"
+        )
+        return
+
+    if args[0] == "every":
+        try:
+            PROFILE_EVERY_N = max(int(args[1]), 0)
+        except (IndexError, ValueError):
+            await update.message.reply_text("Upiši broj: /profiler every <n>")
+            return
+        if PROFILE_EVERY_N == 0:
+            stop_update_profiling()
+        await update.message.reply_text(f"Uzorkovanje svakog n-tog updatea: {PROFILE_EVERY_N or 'isključeno'}.")
+        return
+
+    def report(path: str) -> None:
+        # poziva se iz dretve profilera
+        try:
+            with open(path + ".top.txt", encoding="utf-8") as f:
+                top = "".join(f.readlines()[:17])
+        except OSError:
+            top = ""
+        asyncio.run_coroutine_threadsafe(
+            context.bot.send_message(chat_id, f"🔬 Profil spremljen: {path}.collapsed\n\n{top}"[:4000]),
+            loop,
+        )
+
+    if args[0] == "stop":
+        if _active_profiler is None:
+            await update.message.reply_text("Profiler ne radi.")
+            return
+        # zapisivanje ide u zasebnu dretvu da ne blokira event loop
+        threading.Thread(target=stop_profiling, kwargs={"on_done": report}, daemon=True).start()
+        return
+
+    try:
+        seconds = min(max(float(args[0]), 1.0), 300.0)
+    except ValueError:
+        await update.message.reply_text("Upiši trajanje u sekundama: /profiler 30")
+        return
+
+    if not start_profiling("admin", seconds, on_done=report):
+        await update.message.reply_text("Profiler već radi.")
+        return
+    await update.message.reply_text(f"🔬 Uzorkujem {seconds:.0f} s…")
+
+
 # =====================================================
-# 9. HANDLE MESSAGE – GLAVNA LOGIKA
+# 15. HANDLE MESSAGE – GLAVNA LOGIKA
 # =====================================================
 
 
@@ -497,15 +2396,28 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     user = get_or_create_user(user_id, update.effective_user.full_name)
 
+    # krizni signal ima prednost pred svime – i pred pretplatom
+    phrase = detect_crisis(text)
+    if phrase is not None:
+        if user.mood_pending_rating is not None:
+            add_mood_entry(user, user.mood_pending_rating, text)
+            user.mood_pending_rating = None
+        await handle_crisis(update, context, user, text, phrase)
+        return
+
+    if not user.approved:
+        await update.message.reply_text(NOT_APPROVED_TEXT)
+        return
+
     if not is_subscription_active(user):
         await update.message.reply_text("❌ Tvoja pretplata je istekla.")
         return
 
     # Ako čekamo opis raspoloženja nakon odabira 1–5
-    if user.get("mood_pending_rating") is not None:
-        rating = user["mood_pending_rating"]
+    if user.mood_pending_rating is not None:
+        rating = user.mood_pending_rating
         add_mood_entry(user, rating, text)
-        user["mood_pending_rating"] = None
+        user.mood_pending_rating = None
         save_user(user_id, user)
         await update.message.reply_text("Hvala ti, zapisao sam tvoj unos u dnevnik emocija.")
         return
@@ -519,7 +2431,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 
 # =====================================================
-# 10. INLINE GUMBI (MENI, TERAPIJSKI MOD, DNEVNIK…)
+# 16. INLINE GUMBI (MENI, TERAPIJSKI MOD, DNEVNIK…)
 # =====================================================
 
 
@@ -533,6 +2445,10 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
     user = get_or_create_user(user_id, query.from_user.full_name)
 
+    if not user.approved:
+        await query.edit_message_text(NOT_APPROVED_TEXT)
+        return
+
     if not is_subscription_active(user):
         await query.edit_message_text("❌ Tvoja pretplata je istekla.")
         return
@@ -577,7 +2493,7 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             return
 
         add_mood_entry(user, rating, None)
-        user["mood_pending_rating"] = rating
+        user.mood_pending_rating = rating
         save_user(user_id, user)
 
         await query.edit_message_text(
@@ -586,7 +2502,8 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
 
     if data == "EMOTION_ANALYSIS":
-        await query.edit_message_text(
+        await safe_edit(
+            query,
             "⏳ Radim analizu tvojih unosa u dnevniku emocija…",
             reply_markup=back_keyboard(),
         )
@@ -594,7 +2511,7 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
 
     if data == "TOGGLE_DAILY":
-        user["daily_check"] = not user.get("daily_check", False)
+        user.daily_check = not user.daily_check
         save_user(user_id, user)
 
         # makni prijašnji job, ako postoji
@@ -603,7 +2520,7 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         for j in jobs:
             j.schedule_removal()
 
-        if user["daily_check"]:
+        if user.daily_check:
             schedule_daily(context.application, chat_id)
             msg = "✅ Uključena je dnevna provjera raspoloženja u 20:00."
         else:
@@ -628,7 +2545,7 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     if data.startswith("MODE_"):
         mode = data.replace("MODE_", "")
         if mode == "NONE":
-            user["therapy_mode"] = "NONE"
+            user.therapy_mode = TherapyMode.NONE
             save_user(user_id, user)
             await query.edit_message_text(
                 "🎯 Terapijski mod je isključen.", reply_markup=back_keyboard()
@@ -637,7 +2554,7 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         if mode not in ("CBT", "ACT", "DBT"):
             await query.edit_message_text("Nepoznat terapijski mod.")
             return
-        user["therapy_mode"] = mode
+        user.therapy_mode = TherapyMode(mode)
         save_user(user_id, user)
         await query.edit_message_text(
             f"🎯 Terapijski mod postavljen na: *{mode}*.",
@@ -665,14 +2582,35 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             "(npr. kratka vježba zahvalnosti, disanja, kontakt s nekim bliskim). "
             "Odgovori kratko, 2–3 rečenice, na hrvatskom."
         )
-        challenge = await ai_chat_reply(user, prompt)
-        await query.edit_message_text(
+        challenge, source = await SINGLE_FLIGHT.run(
+            ("DAILY_CHALLENGE", user_id),
+            lambda: ai_chat_reply(user, prompt, feature="challenge"),
+            cache_if=lambda r: not is_ai_failure(r),
+        )
+        if source == "joined":
+            return
+        await safe_edit(
+            query,
             "🎲 *Dnevni izazov:*\n\n" + challenge,
             parse_mode="Markdown",
             reply_markup=back_keyboard(),
         )
         return
 
+    if data.startswith("HIST_PAGE_"):
+        uid = str(chat_id)
+        search = HISTORY_SEARCHES.get(uid)
+        if not search:
+            await query.edit_message_text("Pretraga je istekla. Pošalji ponovno /history <pojam>.")
+            return
+        try:
+            page = int(data.replace("HIST_PAGE_", ""))
+        except ValueError:
+            return
+        text, markup = render_history_page(uid, search[0], search[1], page)
+        await safe_edit(query, text, reply_markup=markup)
+        return
+
     if data == "HELP_MENU":
         await query.edit_message_text(
             "ℹ️ Ovdje si uvijek možeš: \n"
@@ -687,23 +2625,159 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
 
     if data == "TEST_MENU":
+        QUIZ_SESSIONS.pop(user_id, None)
         await query.edit_message_text(
-            "🧪 Psihološki testovi će biti dodani u sljedećoj verziji.",
-            reply_markup=back_keyboard(),
+            TEST_MENU_TEXT, reply_markup=test_menu_keyboard(), parse_mode="Markdown"
         )
         return
 
+    if data.startswith("QUIZ_"):
+        await handle_quiz_button(query, data, user_id, user, context)
+        return
+
     # Fallback
     await query.edit_message_text("✅ Opcija je zaprimljena.")
 
 
 # =====================================================
-# 11. WEBHOOK + EVENT LOOP ZA RENDER
+# 17. PRIORITETNE TRAKE I ODBACIVANJE OPTEREĆENJA
 # =====================================================
 
+LANE_INSTANT = "instant"          # meni, komande, gumbi bez LLM-a
+LANE_CHAT = "chat"                # razgovor s LLM-om
+LANE_BACKGROUND = "background"    # analiza, izazov, izvještaji
+
+LANE_SHED_AFTER = float(os.getenv("LANE_SHED_AFTER", "10"))
+LANE_BACKGROUND_MAX_WAITING = int(os.getenv("LANE_BACKGROUND_MAX_WAITING", "20"))
+SHED_TEXT = (
+    "⏳ Trenutno sam preopterećen pa ovo ne stignem odmah. "
+    "Pokušaj ponovno za minutu – glavni meni (/menu) i dalje radi."
+)
+
+BACKGROUND_CALLBACKS = {"EMOTION_ANALYSIS", "DAILY_CHALLENGE"}
+BACKGROUND_CALLBACK_PREFIXES = ("QUIZ_EXPLAIN_",)
+
+
+class Lane:
+    # vlastiti budžet paralelnosti; "backlog" = updateovi koji čekaju slobodno mjesto
+    def __init__(self, name: str, limit: int) -> None:
+        self.name = name
+        self.limit = limit
+        self.running = 0
+        self.waiting = 0
+        self.completed = 0
+        self.shed = 0
+        self._sem = asyncio.Semaphore(limit)
+        self._backlog_since: float | None = None
+
+    def backlogged_for(self) -> float:
+        if self._backlog_since is None:
+            return 0.0
+        return time.monotonic() - self._backlog_since
+
+    @asynccontextmanager
+    async def slot(self):
+        self.waiting += 1
+        if self._backlog_since is None and self._sem.locked():
+            self._backlog_since = time.monotonic()
+        try:
+            await self._sem.acquire()
+        finally:
+            self.waiting -= 1
+            if not self.waiting:
+                self._backlog_since = None
+        self.running += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self.completed += 1
+            self._sem.release()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "running": self.running,
+            "waiting": self.waiting,
+            "backlogged_s": round(self.backlogged_for(), 1),
+            "completed": self.completed,
+            "shed": self.shed,
+        }
+
+
+LANES: Dict[str, Lane] = {
+    LANE_INSTANT: Lane(LANE_INSTANT, int(os.getenv("LANE_INSTANT_CONCURRENCY", "32"))),
+    LANE_CHAT: Lane(LANE_CHAT, int(os.getenv("LANE_CHAT_CONCURRENCY", "16"))),
+    LANE_BACKGROUND: Lane(LANE_BACKGROUND, int(os.getenv("LANE_BACKGROUND_CONCURRENCY", "4"))),
+}
+
+
+def classify_update(update: Update) -> str:
+    query = update.callback_query
+    if query:
+        data = query.data or ""
+        if data in BACKGROUND_CALLBACKS or data.startswith(BACKGROUND_CALLBACK_PREFIXES):
+            return LANE_BACKGROUND
+        return LANE_INSTANT
+
+    msg = update.message
+    if msg and msg.text and not msg.text.startswith("/"):
+        # krizni signal nikad ne čeka iza LLM razgovora
+        if detect_crisis(msg.text) is not None:
+            return LANE_INSTANT
+        # bilješka za dnevnik emocija ne ide na LLM
+        user = get_user_str(str(update.effective_user.id)) if update.effective_user else None
+        if user is not None and user.mood_pending_rating is not None:
+            return LANE_INSTANT
+        return LANE_CHAT
+
+    return LANE_INSTANT
+
+
+def should_shed(lane: str) -> bool:
+    # odbacuje se samo najniža traka, i to tek kad zastoj potraje
+    if lane != LANE_BACKGROUND:
+        return False
+    bg = LANES[LANE_BACKGROUND]
+    return (
+        bg.waiting >= LANE_BACKGROUND_MAX_WAITING
+        or bg.backlogged_for() >= LANE_SHED_AFTER
+        or LANES[LANE_CHAT].backlogged_for() >= LANE_SHED_AFTER
+    )
+
+
+async def shed_update(update: Update) -> None:
+    if update.callback_query:
+        await update.callback_query.answer(SHED_TEXT, show_alert=True)
+    elif update.effective_chat:
+        await application.bot.send_message(update.effective_chat.id, SHED_TEXT)
+
+
+# =====================================================
+# 18. TRANSPORT (WEBHOOK / LONG POLLING) + EVENT LOOP
+# =====================================================
+
+# BOT_TRANSPORT=webhook (Render, RENDER_EXTERNAL_URL) ili polling (lokalno, benchmark, worker)
+BOT_TRANSPORT = os.getenv("BOT_TRANSPORT", "webhook")
+POLLING_BATCH = int(os.getenv("POLLING_BATCH", "100"))
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", "30"))
+# gornja granica taskova iz getUpdates – stvarnu paralelnost ograničavaju trake (LANES)
+POLLING_CONCURRENCY = int(os.getenv("POLLING_CONCURRENCY", "1000"))
+# Render šalje SIGTERM i nakon ~30 s ubija proces: drain + flush + gašenje PTB-a moraju stati u to
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "20"))
+SHUTDOWN_FLUSH_SECONDS = float(os.getenv("SHUTDOWN_FLUSH_SECONDS", "5"))
+
 app = Flask(__name__)
 application: Application | None = None
 loop = None
+# dugotrajni taskovi na event loopu (health probe…)
+BACKGROUND_TASKS: List[asyncio.Task] = []
+# updateovi u obradi (task → update_id) – na njih se čeka pri gašenju
+INFLIGHT_TASKS: Dict[asyncio.Task, int] = {}
+ACCEPTING = True
+_polling_task: asyncio.Task | None = None
+_polling_offset: int | None = None
+_shutdown_started = False
 
 
 @app.get("/")
@@ -711,47 +2785,162 @@ def index():
     return "Webhook radi.", 200
 
 
+@app.get("/healthz")
+def healthz():
+    snap = health_snapshot()
+    if snap["loop_lag_ms"] > LIVE_MAX_LOOP_STALL_S * 1000:
+        return jsonify(status="stalled", **snap), 503
+    return jsonify(status="ok", **snap), 200
+
+
+@app.get("/readyz")
+def readyz():
+    snap = health_snapshot()
+    if not ACCEPTING:
+        return jsonify(status="draining", **snap), 503
+    problems = readiness_problems(snap)
+    if problems:
+        return jsonify(status="not_ready", problems=problems, **snap), 503
+    return jsonify(status="ready", **snap), 200
+
+
 @app.post(f"/webhook/{TELEGRAM_TOKEN}")
 def telegram_webhook():
     from telegram import Update as TgUpdate
 
     global application, loop
 
+    # za vrijeme gašenja Telegram dobiva 503 i update kasnije šalje ponovno
+    if not ACCEPTING:
+        return "Shutting down", 503
+
     data = request.get_json(force=True)
     if not data:
         return "No JSON", 400
 
+    trace = Trace(data.get("update_id"))
     update = TgUpdate.de_json(data, application.bot)
-    asyncio.run_coroutine_threadsafe(application.process_update(update), loop)
+    asyncio.run_coroutine_threadsafe(dispatch_update(update, trace), loop)
     return "OK", 200
 
 
-async def init_telegram_application() -> None:
+async def dispatch_update(update: Update, trace: Trace) -> None:
+    # trace se postavlja unutar taska na event loopu, pa ga vide svi spanovi ispod
+    _current_trace.set(trace)
+    task = asyncio.current_task()
+    INFLIGHT_TASKS[task] = update.update_id
+    lane_name = classify_update(update)
+    lane = LANES[lane_name]
+    profiled = PROFILE_EVERY_N > 0 and profile_update_begin()
+    HEALTH.inflight_updates += 1
+    try:
+        if should_shed(lane_name):
+            lane.shed += 1
+            with span("shed", lane=lane_name):
+                await shed_update(update)
+            return
+
+        async with lane.slot():
+            with span("dispatch", lane=lane_name):
+                await application.process_update(update)
+    finally:
+        INFLIGHT_TASKS.pop(task, None)
+        HEALTH.inflight_updates -= 1
+        if profiled:
+            profile_update_end()
+        finish_trace(trace, kind=describe_update(update), lane=lane_name)
+
+
+async def polling_loop() -> None:
+    # getUpdates u velikim serijama; svaki update ide u svoju traku bez čekanja na ostale
+    global _polling_offset
+    slots = asyncio.Semaphore(POLLING_CONCURRENCY)
+    while ACCEPTING:
+        try:
+            updates = await application.bot.get_updates(
+                offset=_polling_offset,
+                limit=POLLING_BATCH,
+                timeout=POLLING_TIMEOUT,
+                read_timeout=POLLING_TIMEOUT + 10,
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("getUpdates nije uspio")
+            await asyncio.sleep(2)
+            continue
+
+        for update in updates:
+            await slots.acquire()
+            task = asyncio.create_task(dispatch_update(update, Trace(update.update_id)))
+            task.add_done_callback(lambda _: slots.release())
+            # offset tek kad je update predan – prekid dok čeka slot ga ne smije potvrditi
+            _polling_offset = update.update_id + 1
+
+
+async def init_telegram_application(transport: str) -> None:
     global application
 
-    application = Application.builder().token(TELEGRAM_TOKEN).updater(None).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .updater(None)
+        .request(TracedRequest())
+        # getUpdates je uvijek samo jedan poziv odjednom
+        .get_updates_request(TracedRequest(connection_pool_size=1))
+        .build()
+    )
 
     # komande
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_cmd))
-    application.add_handler(CommandHandler("status", status_cmd))
-    application.add_handler(CommandHandler("profile", profile_cmd))
-    application.add_handler(CommandHandler("menu", menu_cmd))
-    application.add_handler(CommandHandler("meni", menu_cmd))
-    application.add_handler(CommandHandler("mood", mood_cmd))
-    application.add_handler(CommandHandler("history", history_cmd))
-    application.add_handler(CommandHandler("weekly", weekly_cmd))
-    application.add_handler(CommandHandler("tests", tests_cmd))
+    application.add_handler(CommandHandler("start", traced_handler(start)))
+    application.add_handler(CommandHandler("help", traced_handler(help_cmd)))
+    application.add_handler(CommandHandler("status", traced_handler(status_cmd)))
+    application.add_handler(CommandHandler("profile", traced_handler(profile_cmd)))
+    application.add_handler(CommandHandler("menu", traced_handler(menu_cmd)))
+    application.add_handler(CommandHandler("meni", traced_handler(menu_cmd)))
+    application.add_handler(CommandHandler("mood", traced_handler(mood_cmd)))
+    application.add_handler(CommandHandler("history", traced_handler(history_cmd)))
+    application.add_handler(CommandHandler("weekly", traced_handler(weekly_cmd)))
+    application.add_handler(CommandHandler("tests", traced_handler(tests_cmd)))
+
+    # admin
+    application.add_handler(CommandHandler("pending", traced_handler(pending_cmd)))
+    application.add_handler(CommandHandler("approve", traced_handler(approve_cmd)))
+    application.add_handler(CommandHandler("flagged", traced_handler(flagged_cmd)))
+    application.add_handler(CommandHandler("unflag", traced_handler(unflag_cmd)))
+    application.add_handler(CommandHandler("slow", traced_handler(slow_cmd)))
+    application.add_handler(CommandHandler("profiler", traced_handler(profiler_cmd)))
 
     # inline gumbi
-    application.add_handler(CallbackQueryHandler(handle_button))
+    application.add_handler(CallbackQueryHandler(traced_handler(handle_button)))
 
     # tekst poruke
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(
+        MessageHandler(filters.TEXT & ~filters.COMMAND, traced_handler(handle_message))
+    )
 
     await application.initialize()
     await application.start()
 
+    ev_loop = asyncio.get_running_loop()
+    BACKGROUND_TASKS.append(ev_loop.create_task(loop_lag_probe()))
+    BACKGROUND_TASKS.append(ev_loop.create_task(storage_flush_loop()))
+
+    if application.job_queue is None:
+        logger.warning("JobQueue nije dostupan – instaliraj python-telegram-bot[job-queue]")
+    else:
+        restored = restore_scheduler_state(application)
+        print(f"⏰ Dnevnih provjera: {restored}")
+
+    if transport == "polling":
+        # webhook i getUpdates se isključuju – stari webhook treba maknuti
+        await application.bot.delete_webhook()
+        print(f"🔁 Long polling (serije do {POLLING_BATCH}, paralelno do {POLLING_CONCURRENCY})")
+        global _polling_task
+        _polling_task = ev_loop.create_task(polling_loop())
+        BACKGROUND_TASKS.append(_polling_task)
+        return
+
     external_url = os.environ.get("RENDER_EXTERNAL_URL")
     if not external_url:
         raise RuntimeError("RENDER_EXTERNAL_URL nije postavljen!")
@@ -761,26 +2950,135 @@ async def init_telegram_application() -> None:
     await application.bot.set_webhook(url=webhook_url)
 
 
+async def shutdown(reason: str) -> None:
+    # 1) ne primaj nove updateove, 2) pričekaj one u obradi, 3) spremi stanje, 4) ugasi PTB
+    global ACCEPTING, _shutdown_started
+    if _shutdown_started:
+        return
+    _shutdown_started = True
+    ACCEPTING = False
+
+    ev_loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    deadline = ev_loop.time() + SHUTDOWN_DRAIN_SECONDS
+    print(f"🛑 Gašenje ({reason}) – čekam {len(INFLIGHT_TASKS)} updateova u obradi…")
+
+    if _polling_task is not None:
+        _polling_task.cancel()
+
+    # webhook zahtjevi primljeni netom prije zatvaranja još se predaju loopu
+    await asyncio.sleep(0.1)
+    seen: set[asyncio.Task] = set()
+    while True:
+        pending = {t for t in INFLIGHT_TASKS if not t.done()}
+        seen |= pending
+        remaining = deadline - ev_loop.time()
+        if not pending or remaining <= 0:
+            break
+        await asyncio.wait(pending, timeout=remaining)
+
+    abandoned = {t: uid for t, uid in INFLIGHT_TASKS.items() if not t.done()}
+    for t in abandoned:
+        t.cancel()
+    if abandoned:
+        await asyncio.wait(abandoned, timeout=1)
+    drain_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    # polling: potvrdi obrađene updateove da ih Telegram ne pošalje ponovno –
+    # ali samo do prvog prekinutog, da se on i ostali iza njega ponovno isporuče
+    ack_offset = _polling_offset
+    if ack_offset is not None and abandoned:
+        ack_offset = min(ack_offset, min(abandoned.values()))
+    if ack_offset is not None:
+        try:
+            await application.bot.get_updates(offset=ack_offset, limit=1, timeout=0)
+        except Exception:
+            logger.exception("Potvrda offseta nije uspjela")
+
+    # periodički flush se mora ugasiti prije završnog; zapis koji je već u dretvi
+    # dovršava se pod _storage_write_lock prije našeg
+    for t in BACKGROUND_TASKS:
+        t.cancel()
+    await asyncio.gather(*BACKGROUND_TASKS, return_exceptions=True)
+
+    async def final_flush() -> int:
+        await flush_users_async()
+        await flush_conversations_async()
+        if application.job_queue is None:
+            return 0
+        return await save_scheduler_state(application)
+
+    flush_started = time.perf_counter()
+    scheduled = 0
+    try:
+        scheduled = await asyncio.wait_for(final_flush(), SHUTDOWN_FLUSH_SECONDS)
+    except asyncio.TimeoutError:
+        logger.error("Spremanje pri gašenju nije stalo u %.0f s", SHUTDOWN_FLUSH_SECONDS)
+    except Exception:
+        logger.exception("Spremanje podataka pri gašenju nije uspjelo")
+    flush_ms = round((time.perf_counter() - flush_started) * 1000, 1)
+
+    await application.stop()
+    await application.shutdown()
+
+    log_event(
+        "shutdown",
+        reason=reason,
+        drain_ms=drain_ms,
+        drained=len(seen) - len(abandoned),
+        abandoned=len(abandoned),
+        ack_offset=ack_offset,
+        flush_ms=flush_ms,
+        scheduled_jobs=scheduled,
+        total_ms=round((time.perf_counter() - started) * 1000, 1),
+    )
+    ev_loop.stop()
+
+
 def start_flask() -> None:
     port = int(os.environ.get("PORT", "10000"))
     print(f"🚀 Flask na portu {port}")
     app.run(host="0.0.0.0", port=port)
 
 
-if __name__ == "__main__":
-    print("🤖 Pokrećem Psiholog Bot WEBHOOK verziju (Render)…")
+def main(argv: List[str] | None = None) -> None:
+    global loop
+
+    args = sys.argv[1:] if argv is None else argv
+    transport = (args[0] if args else BOT_TRANSPORT).lower()
+    if transport not in ("webhook", "polling"):
+        raise RuntimeError("Transport mora biti 'webhook' ili 'polling'!")
+
+    print(f"🤖 Pokrećem Psiholog Bot ({transport})…")
 
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
 
-    loop.run_until_complete(init_telegram_application())
+    if PROFILE_ON_START > 0:
+        start_profiling("startup", PROFILE_ON_START)
 
+    loop.run_until_complete(init_telegram_application(transport))
+
+    # Flask radi i u polling modu – /healthz i /readyz
     threading.Thread(target=start_flask, daemon=True).start()
 
-    print("✅ Bot i webhook su pokrenuti.")
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, lambda s=sig: loop.create_task(shutdown(s.name)))
+        except NotImplementedError:
+            # Windows – ostaje samo KeyboardInterrupt
+            pass
+
+    print("✅ Bot je pokrenut.")
 
-    # drži event loop živim
+    # drži event loop živim do shutdown()
     try:
         loop.run_forever()
     except KeyboardInterrupt:
-        pass
+        loop.run_until_complete(shutdown("KeyboardInterrupt"))
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
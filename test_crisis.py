@@ -0,0 +1,91 @@
+# Krizni signali – brza sigurnosna staza ne smije tiho prestati prepoznavati
+# uobičajene formulacije (ni početi hvatati obične rečenice).
+# Pokretanje: python -m pytest -q test_crisis.py
+
+import os
+import importlib
+
+import pytest
+
+for _dep in ("telegram", "flask", "openai", "dotenv"):
+    pytest.importorskip(_dep)
+
+os.environ.setdefault("TELEGRAM_TOKEN", "test-token")
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+
+@pytest.fixture(scope="module")
+def detect_crisis(tmp_path_factory):
+    # modul pri importu stvara users.json / conversations.json u radnom direktoriju
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("bot"))
+    try:
+        bot = importlib.import_module("psiholog_bot_render")
+    finally:
+        os.chdir(cwd)
+    return bot.detect_crisis
+
+
+CRISIS = [
+    "Želim se ubiti",
+    "hoću se ubiti",
+    "htio bih se ubiti",
+    "htjela bih se ubiti",
+    "Razmišljam da se ubijem",
+    "najbolje da se ubijem",
+    "Mislim da ću se ubiti večeras",
+    "ubiti ću se",
+    "ubit cu se",
+    "sutra se ubijam",
+    "porezala sam se",
+    "opet sam se porezao",
+    "ozlijedit ću se",
+    "ozljeđujem se već mjesecima",
+    "režem se kad mi je teško",
+    "objesit ću se",
+    "mislim na samoubojstvo",
+    "želim umrijeti",
+    "hoću da umrem",
+    "htjela bih umrijeti",
+    "ne želim više živjeti",
+    "nemam razloga živjeti",
+    "bolje bi bilo da me nema",
+    "oduzet ću si život",
+    "skočit ću s mosta",
+    "bacit ću se pod vlak",
+    "popit ću sve tablete i predozirati se",
+    "osjećam se kao samoubojica",
+    "ponekad poželim umrijeti",
+    "Ne želim da živim",
+    "želim stvarno umrijeti",
+    "ne želim nikad više živjeti",
+    "nemam više razloga živjeti",
+]
+
+NOT_CRISIS = [
+    "ubit ću sestru ako mi opet uzme punjač",
+    "ubila sam komarca",
+    "porezala sam kruh",
+    "bojim se poreza",
+    "objesila sam sliku",
+    "ozljeda koljena me muči",
+    "skočit ću sutra do trgovine",
+    "želim umjetnost u životu",
+    "rezervirala sam si stol",
+    "sestra se udala",
+    "danas sam se dobro naspavala",
+    "skočit ću sutra s posla do tebe",
+    "ne želim ništa, samo odmor",
+    "želim se umiti i leći",
+    "",
+]
+
+
+@pytest.mark.parametrize("text", CRISIS)
+def test_detects_crisis(detect_crisis, text):
+    assert detect_crisis(text) is not None
+
+
+@pytest.mark.parametrize("text", NOT_CRISIS)
+def test_ignores_ordinary_text(detect_crisis, text):
+    assert detect_crisis(text) is None